@@ -1,21 +1,27 @@
-import essentia
-essentia.log.warningActive = False
-
 import os
 import math
+import time
 import click
 import shutil
 import random
+import itertools
 from glob import glob
 from colorama import Fore
 from datetime import datetime
-from pablo import analysis, mutate, heuristics, producer, diglet
-from pablo.models.sample import Slice
-from pablo.models.song import Song
+from pablo import cache
 
+# The heavier modules (and their dependencies, e.g. essentia)
+# are imported by the commands which use them,
+# so that startup (e.g. `pablo --help`) stays fast
 
+# Song formats to look for in libraries
 formats = ['mp3', 'wav', 'aif']
 
+# Formats `pablo dig` may download songs in (without transcoding them),
+# which can be analyzed but which sox can't decode,
+# so they can only be mixed with the numpy backend
+native_formats = ['m4a', 'webm', 'opus', 'ogg']
+
 
 @click.group()
 def cli():
@@ -28,22 +34,78 @@ def echo(tmp, *txts, **kwargs):
     print(tmp.format(*txts))
 
 
+def _library_files(library, backend='numpy'):
+    """
+    The songs in a library. Songs in the `native_formats`
+    are left out for the sox backend, which can't decode them.
+    """
+    files = []
+    for fmt in formats:
+        files += glob(os.path.join(library, '*.{0}'.format(fmt)))
+
+    native = []
+    for fmt in native_formats:
+        native += glob(os.path.join(library, '*.{0}'.format(fmt)))
+    if backend == 'sox' and native:
+        echo('Skipping {0} songs which sox can\'t decode (mix them with -b numpy)', len(native), color=Fore.YELLOW)
+        return files
+    return files + native
+
+
+def _library(files):
+    """
+    Indexes songs (see `Library`), showing progress
+    since it takes a while for songs which haven't been seen before.
+    """
+    from pablo.library import Library
+
+    with click.progressbar(length=len(files), label='Looking up songs') as bar:
+        return Library(files, progress=lambda f: bar.update(1))
+
+
+def _native(song):
+    return os.path.splitext(song)[1][1:].lower() in native_formats
+
+
 @cli.command()
 @click.argument('library', type=click.Path(exists=True))
-def analyze(library):
+@click.option('-j', '--jobs', default=1, help='The number of songs to analyze in parallel (0 for one per CPU)', type=int)
+def analyze(library, jobs):
     """
     Analyze all songs in a directory
 
     Their analyses will be persisted to a local db.
+    Songs which have already been analyzed are skipped,
+    so an interrupted run can just be restarted.
     """
-    files = []
-    for fmt in formats:
-        files += glob(os.path.join(library, '*.{0}'.format(fmt)))
+    from pablo import analysis
+
+    files = _library_files(library)
+
+    with click.progressbar(length=len(files), label='Looking up songs') as bar:
+        pending = analysis.pending(files, progress=lambda f: bar.update(1))
+    if len(pending) < len(files):
+        echo('Skipping {0} already analyzed songs', len(files) - len(pending))
+
+    echo('Analyzing {0} songs...', len(pending))
+    failed = []
+    start = time.time()
+
+    def throughput(item):
+        if item is None or not bar.pos:
+            return None
+        return '{0:.2f} songs/s'.format(bar.pos/(time.time() - start))
 
-    echo('Analyzing {0} songs...', len(files))
-    with click.progressbar(files) as bar:
-        for f in bar:
-            analysis.analyze(f)
+    results = analysis.analyze_many(pending, jobs=jobs or None)
+    with click.progressbar(results, length=len(pending), show_eta=True, show_pos=True, item_show_func=throughput) as bar:
+        for f, bpm, key in bar:
+            if bpm is None:
+                failed.append(f)
+
+    if failed:
+        echo('\n{0} songs could not be analyzed:', len(failed), color=Fore.RED)
+        for f in failed:
+            echo('\t{0}', f, color=Fore.RED)
 
 
 @cli.command()
@@ -52,6 +114,8 @@ def analyze_song(song):
     """
     Analyze a single song
     """
+    from pablo import analysis
+
     bpm, key = analysis.analyze(song)
     echo('\tBPM: {0}', bpm)
     echo('\tKey: {0} ({1})', key.key, key.scale)
@@ -66,6 +130,8 @@ def compatible(song, library, outdir, keyshift):
     """
     Returns mix-compatible songs for the given song in the given library
     """
+    from pablo import analysis, mutate
+
     focal_bpm, focal_key = analysis.analyze(song)
 
     echo('Finding compatible songs for {0}', song, color=Fore.CYAN)
@@ -74,38 +140,39 @@ def compatible(song, library, outdir, keyshift):
 
     # Search for songs that require relatively small modifications
     # to match the focal song
-    bpm_range_l = 0.85 * focal_bpm
-    bpm_range_u = 1.15 * focal_bpm
+    bpm_range = 0.15
     key_range = 3
 
     echo('Using library at {0}', library, color=Fore.CYAN)
 
-    files = []
-    for fmt in formats:
-        files += glob(os.path.join(library, '*.{0}'.format(fmt)))
+    files = _library_files(library, backend='sox' if keyshift else 'numpy')
 
     echo('Working with {0} songs', len(files))
 
+    # Analyze any songs that haven't been yet,
+    # so the whole library can be queried
+    lib = _library(files)
+    unanalyzed = lib.unanalyzed
+    if unanalyzed:
+        echo('Analyzing {0} songs...', len(unanalyzed))
+        with click.progressbar(analysis.analyze_many(unanalyzed), length=len(unanalyzed)) as bar:
+            for _ in bar:
+                pass
+
     # Select appropriate songs to mix
     echo('\n{0}', 'Compatible songs:', color=Fore.YELLOW)
-    selections = []
-
-    while files:
-        song = files.pop()
-        bpm, key = analysis.analyze(song)
-        if bpm_range_l <= bpm <= bpm_range_u and (focal_key.mixable(key) or abs(focal_key.distance(key)) <= key_range):
-            selections.append(song)
-            echo('{0}', song, color=Fore.CYAN)
+    selections = lib.compatible(focal_bpm, focal_key, bpm_range=bpm_range, key_range=key_range)
+    for song, bpm, key in selections:
+        echo('{0}', song, color=Fore.CYAN)
 
     if outdir is not None:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
-        for song in selections:
+        for song, bpm, key in selections:
             fname = os.path.basename(song)
             outfile = os.path.join(outdir, fname)
 
             if keyshift and not focal_key.mixable(key):
-                bpm, key = analysis.analyze(song)
                 mutate.key_shift(song, key, focal_key, outfile)
             else:
                 shutil.copy(song, outfile)
@@ -116,9 +183,32 @@ def compatible(song, library, outdir, keyshift):
 @click.argument('outdir', type=click.Path(exists=True))
 @click.option('-D', 'depth', default=2, help='How many levels of related vids to dig through', type=int)
 @click.option('-T', 'max_duration', default=360, help='Only download videos below or equal to this duration', type=int)
-def dig(start, outdir, depth, max_duration):
+@click.option('-j', '--jobs', default=8, help='The number of pages to fetch at once', type=int)
+@click.option('--no-transcode', is_flag=True, help='Keep downloads in their own format instead of transcoding them to mp3 (mix them with `-b numpy`)')
+@click.option('-a', '--analyze', is_flag=True, help='Analyze songs as soon as they\'re downloaded')
+@click.option('--analysis-jobs', default=1, help='With -a, the number of songs to analyze in parallel (0 for one per CPU)', type=int)
+def dig(start, outdir, depth, max_duration, jobs, no_transcode, analyze, analysis_jobs):
+    """
+    Download songs from YouTube, following related videos
+
+    With -a, the songs are analyzed while the rest are
+    downloading, so they're ready to mix once the dig is done.
+    """
+    from pablo import diglet
+
     echo('Digging from {0}', start, color=Fore.CYAN)
-    diglet.dig(start, outdir, depth, max_duration)
+    skipped = diglet.dig(start, outdir, depth, max_duration, jobs=jobs,
+                         transcode=not no_transcode,
+                         analyze=analyze,
+                         analysis_jobs=analysis_jobs or None,
+                         log=echo)
+    reasons = [(diglet.DOWNLOADED, 'already downloaded'),
+               (diglet.DUPLICATE, 'identical to a known file'),
+               (diglet.FILTERED, 'too long')]
+    for status, reason in reasons:
+        n = sum(1 for _, s in skipped if s == status)
+        if n:
+            echo('Skipped {0} videos ({1})', n, reason)
     echo('{0}', 'Done digging')
 
 
@@ -132,163 +222,232 @@ def dig(start, outdir, depth, max_duration):
 @click.option('-S', 'n_songs', default=None, help='The number of songs to include (if enough are available)', type=int)
 @click.option('-M', 'length', default=512, help='The length in beats for the song. Should be a power of 2', type=int)
 @click.option('-f', 'sample_format', default='mp3', help='File format for the samples')
+@click.option('-b', 'backend', default='sox', help='How to stretch and shift songs; "numpy" also stretches samples to exactly fit the beat', type=click.Choice(['sox', 'numpy']))
+@click.option('--cache-size', 'cache_size', default=cache.MAX_SIZE//1024**2, help='Disk budget (in MB) for caching processed songs across mixes; 0 to disable', type=int)
+@click.option('-j', '--jobs', default=0, help='The number of songs to process in parallel (0 for one per CPU)', type=int)
+@click.option('--verify-beats', 'verify_beats', is_flag=True, help='Track beats again on processed songs instead of deriving them (slow)')
+@click.option('--seed', default=None, help='Seed for selecting songs and arranging the mix, to make the same plan again from the same library', type=int)
+@click.option('--plan-only', 'plan_only', is_flag=True, help='Only plan the mix (songs are still processed and sliced); render it later with `pablo render`, or plan it again with `pablo replan`')
+@click.option('--stream', is_flag=True, help='Render the mix in constant memory, without saving its tracks separately')
 @click.option('--debug', is_flag=True, help='If set, will debug with click track')
 @click.option('--incoherent', is_flag=True, help='Make an "incoherent" mix (don\'t use markov chains)')
-def mix(library, outdir, focal, max_sample_size, min_sample_size, n_tracks, n_songs, length, sample_format, incoherent, debug):
+def mix(library, outdir, focal, max_sample_size, min_sample_size, n_tracks, n_songs, length, sample_format, backend, cache_size, jobs, verify_beats, seed, plan_only, stream, incoherent, debug):
     """
     Create a mix
     """
-    if max_sample_size < min_sample_size:
-        echo('{0}', 'The max sample size must be larger than the min sample size', color=Fore.RED)
-        return
+    from pablo import pipeline
 
-    n_u = math.log(max_sample_size, 2)
-    if int(n_u) != n_u:
-        echo('{0}', 'The max sample size must be a power of 2', color=Fore.RED)
+    error = pipeline.validate(min_sample_size, max_sample_size, n_tracks, n_songs, length)
+    if error is None and backend == 'sox' and focal is not None and _native(focal):
+        error = 'sox can\'t decode the focal song, use -b numpy'
+    if error is not None:
+        echo('{0}', error, color=Fore.RED)
         return
 
-    n_l = math.log(min_sample_size, 2)
-    if int(n_l) != n_l:
-        echo('{0}', 'The min sample size must be a power of 2', color=Fore.RED)
+    sample_sizes = [2**n for n in range(int(math.log(min_sample_size, 2)), int(math.log(max_sample_size, 2)) + 1)]
+
+    # Prepare output directory, just to check if the directory is not empty
+    outdir = os.path.join(outdir, 'pablo_mix_{}'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+    if os.path.exists(outdir) and os.listdir(outdir):
+        echo('{0}', 'Output directory is not empty', color=Fore.RED)
         return
+    os.makedirs(outdir)
 
-    dur = math.log(length, 2)
-    if int(dur) != dur:
-        echo('{0}', 'The song length must be a power of 2', color=Fore.RED)
+    echo('Using library at {0}', library, color=Fore.CYAN)
+
+    files = _library_files(library, backend=backend)
+
+    echo('Working with {0} songs', len(files))
+
+    if seed is None:
+        seed = random.getrandbits(32)
+    echo('Seed: {0}', seed)
+
+    lib = _library(files)
+    focal, selections = pipeline.select_songs(lib, focal=focal, n_tracks=n_tracks, n_songs=n_songs, seed=seed, log=echo)
+    result = pipeline.make_mix(focal, selections, outdir, sample_sizes,
+                               n_tracks=n_tracks,
+                               length=length,
+                               sample_format=sample_format,
+                               backend=backend,
+                               cache_size=cache_size,
+                               jobs=jobs,
+                               coherent=not incoherent,
+                               verify_beats=verify_beats,
+                               debug=debug,
+                               seed=seed,
+                               plan_only=plan_only,
+                               stream=stream,
+                               log=echo)
+
+    if plan_only:
+        echo('\nPlanned the mix at {0}', result, color=Fore.GREEN)
         return
 
-    if n_songs is not None and n_tracks > n_songs:
-        echo('{0}', 'There must be at least as many songs as there are tracks', color=Fore.RED)
+    echo('\n{0}', 'The new pablo track just dropped ~ (done)')
+
+
+@cli.command()
+@click.argument('mix_dir', type=click.Path(exists=True))
+@click.option('--seed', 'seeds', multiple=True, help='Seed for arranging the mix (repeatable)', type=int)
+@click.option('-N', 'n_plans', default=1, help='Without --seed, the number of plans to make (with random seeds)', type=int)
+@click.option('-T', 'n_tracks', default=2, help='The number of tracks to produce and mix together', type=int)
+@click.option('-M', 'length', default=512, help='The length in beats for the song. Should be a power of 2', type=int)
+@click.option('--incoherent', is_flag=True, help='Make an "incoherent" mix (don\'t use markov chains)')
+def replan(mix_dir, seeds, n_plans, n_tracks, length, incoherent):
+    """
+    Plan a mix again from an earlier mix's slices
+
+    The songs aren't processed again, so many plans can be made quickly,
+    e.g. to try other seeds. Render them with `pablo render`.
+    """
+    from pablo import pipeline
+
+    for seed in seeds or [None] * n_plans:
+        plan_file = pipeline.replan(mix_dir, seed=seed, length=length, coherent=not incoherent, n_tracks=n_tracks)
+        echo('Planned {0}', plan_file, color=Fore.CYAN)
+
+
+@cli.command()
+@click.argument('plan', type=click.Path(exists=True))
+@click.option('-o', 'outdir', default=None, help='Where to render the mix (defaults to alongside the plan)', type=click.Path())
+@click.option('--stream', is_flag=True, help='Render the mix in constant memory, without saving its tracks separately')
+def render(plan, outdir, stream):
+    """
+    Render a planned mix
+    """
+    from pablo import pipeline, producer
+
+    outdir = outdir or os.path.dirname(os.path.abspath(plan))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    mix_file = pipeline.render(producer.load_plan(plan), outdir, stream=stream, log=echo)
+    echo('\nRendered {0}', mix_file, color=Fore.GREEN)
+
+
+@cli.command()
+@click.argument('library', type=click.Path(exists=True))
+@click.argument('outdir', type=click.Path())
+@click.option('-N', 'n_mixes', default=10, help='The number of mixes to create', type=int)
+@click.option('-F', 'focals', multiple=True, help='Songs to base the mixes around', type=click.Path(exists=True))
+@click.option('-C', 'max_sample_sizes', default=[32], multiple=True, help='The max sample size to generate samples with. Should be a power of 2', type=int)
+@click.option('-c', 'min_sample_sizes', default=[16], multiple=True, help='The min sample size to generate samples with. Should be a power of 2', type=int)
+@click.option('-T', 'n_tracks', default=[2], multiple=True, help='The number of tracks to produce and mix together', type=int)
+@click.option('-S', 'n_songs', multiple=True, help='The number of songs to include (if enough are available)', type=int)
+@click.option('-M', 'lengths', default=[512], multiple=True, help='The length in beats for the song. Should be a power of 2', type=int)
+@click.option('-f', 'sample_format', default='mp3', help='File format for the samples')
+@click.option('-b', 'backend', default='sox', help='How to stretch and shift songs; "numpy" also stretches samples to exactly fit the beat', type=click.Choice(['sox', 'numpy']))
+@click.option('--cache-size', 'cache_size', default=cache.MAX_SIZE//1024**2, help='Disk budget (in MB) for caching processed songs across mixes; 0 to disable', type=int)
+@click.option('-j', '--jobs', default=0, help='The number of mixes to make in parallel (0 for one per CPU)', type=int)
+@click.option('--incoherent', is_flag=True, help='Make "incoherent" mixes (don\'t use markov chains)')
+def batch(library, outdir, n_mixes, focals, max_sample_sizes, min_sample_sizes, n_tracks, n_songs, lengths, sample_format, backend, cache_size, jobs, incoherent):
+    """
+    Create many mixes from one library
+
+    Options marked as repeatable can be given several times,
+    e.g. `-T 2 -T 3`, and the mixes will cycle through every
+    combination of their values (and through the focal songs).
+    """
+    from pablo import analysis, pipeline
+
+    if n_mixes < 1:
+        echo('{0}', 'There must be at least one mix', color=Fore.RED)
+        return
+    if backend == 'sox' and any(_native(f) for f in focals):
+        echo('{0}', 'sox can\'t decode some of the focal songs, use -b numpy', color=Fore.RED)
         return
 
-    sample_sizes = [2**n for n in range(int(n_l), int(n_u) + 1)]
+    grid = []
+    for params in itertools.product(max_sample_sizes, min_sample_sizes, n_tracks, n_songs or [None], lengths):
+        max_size, min_size, n_trks, n_sngs, lngth = params
+        error = pipeline.validate(min_size, max_size, n_trks, n_sngs, lngth)
+        if error is not None:
+            echo('Skipping -C {0} -c {1} -T {2} -S {3} -M {4}: {5}', *(params + (error,)), color=Fore.RED)
+        else:
+            grid.append(params)
+    if not grid:
+        return
 
-    # Prepare output directory, just to check if the directory is not empty
-    outdir = os.path.join(outdir, 'pablo_mix_{}'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
-    sample_dir = os.path.join(outdir, 'samples')
+    outdir = os.path.join(outdir, 'pablo_batch_{}'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
     if os.path.exists(outdir) and os.listdir(outdir):
         echo('{0}', 'Output directory is not empty', color=Fore.RED)
         return
-    os.makedirs(sample_dir)
 
     echo('Using library at {0}', library, color=Fore.CYAN)
 
-    files = []
-    for fmt in formats:
-        files += glob(os.path.join(library, '*.{0}'.format(fmt)))
+    files = _library_files(library, backend=backend)
 
     echo('Working with {0} songs', len(files))
 
-    random.shuffle(files)
-
-    # Select a song to base the mix around
-    if focal is None:
-        focal = files.pop()
-    else:
-        files = [f for f in files if f != focal]
-    focal_bpm, focal_key = analysis.analyze(focal)
+    # Analyze the whole library up front, so
+    # selecting songs for each mix is just a query
+    lib = _library(files)
+    unanalyzed = lib.unanalyzed
+    if unanalyzed:
+        echo('Analyzing {0} songs...', len(unanalyzed))
+        with click.progressbar(analysis.analyze_many(unanalyzed, jobs=jobs or None), length=len(unanalyzed)) as bar:
+            for _ in bar:
+                pass
+
+    # Select the songs for every mix here, then
+    # make the mixes in parallel. Each mix gets its own seed,
+    # since otherwise each process would make the same random choices
+    mixes = []
+    for i in range(n_mixes):
+        max_size, min_size, n_trks, n_sngs, lngth = grid[i % len(grid)]
+        focal = focals[i % len(focals)] if focals else None
+        seed = random.getrandbits(32)
+        focal, selections = pipeline.select_songs(lib, focal=focal, n_tracks=n_trks, n_songs=n_sngs, seed=seed)
+        sample_sizes = [2**n for n in range(int(math.log(min_size, 2)), int(math.log(max_size, 2)) + 1)]
+        mix_dir = os.path.join(outdir, 'mix_{0:03d}'.format(i))
+        os.makedirs(mix_dir)
+        mixes.append(((focal, selections, mix_dir, sample_sizes), {
+            'n_tracks': n_trks,
+            'length': lngth,
+            'sample_format': sample_format,
+            'backend': backend,
+            'cache_size': cache_size,
+            'coherent': not incoherent,
+            'seed': seed,
+            'jobs': 1
+        }))
+
+    echo('\nMaking {0} mixes...', n_mixes, color=Fore.YELLOW)
+    failed = 0
+    for mix_dir, seed, mix_file, error in _make_mixes(mixes, jobs=jobs):
+        if error is None:
+            echo('Made {0}', mix_file, color=Fore.CYAN)
+        else:
+            failed += 1
+            echo('Could not make {0} (seed {1}): {2}', mix_dir, seed, error, color=Fore.RED)
 
-    echo('\nFocal song: {0}', focal, color=Fore.YELLOW)
-    echo('\tBPM: {0}', focal_bpm)
-    echo('\tKey: {0} ({1})', focal_key.key, focal_key.scale)
+    if failed:
+        echo('\n{0} of the mixes could not be made', failed, color=Fore.RED)
+    echo('\n{0}', 'The new pablo tracks just dropped ~ (done)')
 
-    # Search for songs that require relatively small modifications
-    # to match the focal song
-    bpm_range_l = 0.85 * focal_bpm
-    bpm_range_u = 1.15 * focal_bpm
-    key_range = 6
 
-    # Select appropriate songs to mix
-    n = n_songs if n_songs is not None else random.randint(n_tracks+2, n_tracks+6)
-    selections = []
-    echo('\nSelecting {0} other songs', n)
-
-    while len(selections) < n and files:
-        song = files.pop()
-        bpm, key = analysis.analyze(song)
-        echo('Analyzing {0}', song, color=Fore.CYAN)
-        if bpm_range_l <= bpm <= bpm_range_u and (focal_key.mixable(key) or abs(focal_key.distance(key)) <= key_range):
-            echo('\t{0}', 'OK')
-            selections.append((song, bpm, key))
-        else:
-            echo('\tSkipping')
-
-    # Mutate songs as needed and generate samples
-    echo('\n{0}', 'Processing songs', color=Fore.YELLOW)
-    slices = {}
-    for song, bpm, key in selections + [(focal, focal_bpm, focal_key)]:
-        filename = os.path.basename(song)
-        name, ext = os.path.splitext(filename)
-        echo('Processing {0}', filename, color=Fore.CYAN)
-
-        # Copy over files
-        outfile = os.path.join(outdir, filename)
-        shutil.copy(song, outfile)
-        tmpfile = os.path.join(outdir, '{0}.tmp{1}'.format(name, ext))
-
-        # Process as necessary
-        if not focal_key.mixable(key):
-            echo('\tChanging key')
-            mutate.key_shift(outfile, key, focal_key, tmpfile)
-            shutil.move(tmpfile, outfile)
-
-        if focal_bpm != bpm:
-            echo('\tChanging bpm')
-            mutate.tempo_stretch(outfile, bpm, focal_bpm, tmpfile)
-            shutil.move(tmpfile, outfile)
-
-        # Trim silence
-        echo('\tTrimming silence')
-        mutate.trim_silence(outfile, tmpfile)
-        shutil.move(tmpfile, outfile)
-
-        # Slice according to beats
-        echo('\tSlicing')
-        beats = analysis.estimate_beats(outfile)
-
-        # If debug is set, add click track to check beat alignment
-        if debug:
-            mutate.add_click(outfile, beats, tmpfile)
-            shutil.move(tmpfile, outfile)
-
-        song_sample_dir = os.path.join(sample_dir, name)
-        os.makedirs(song_sample_dir)
-
-        # Assemble samples of the smallest sample size
-        # They will be combined later into larger samples
-        prefix = '{0}_{1}_'.format(name, min_sample_size)
-        slices[name] = [Slice(f) for f in mutate.beat_slice(outfile,
-                                                           beats,
-                                                           min_sample_size,
-                                                           song_sample_dir,
-                                                           prefix=prefix,
-                                                           format=sample_format)]
-
-    # Remove samples which have irregular duration
-    slices = heuristics.filter_slices(slices)
-
-    # Build songs + samples out of the slices
-    # Some songs may return no slices, in which case, ignore that song.
-    songs = [Song(nm, slics, sample_sizes) for nm, slics in slices.items() if any(s is not None for s in slics)]
-
-    # Select samples and assemble tracks
-    echo('\n{0}', 'Assembling tracks', color=Fore.YELLOW)
-    tracks, tracklist = producer.produce_tracks(songs,
-                                                outdir,
-                                                length=length,
-                                                coherent=not incoherent,
-                                                n_tracks=n_tracks)
-
-    # Overlay the tracks
-    echo('{0}', 'Assembling mix', color=Fore.YELLOW)
-
-    mix_file = os.path.join(outdir, '_mix.mp3')
-    producer.produce_mix(tracks, mix_file, format='mp3')
-
-    # Write the tracklist
-    tracklisting = '\n\n---\n\n'.join(['\n'.join(['{0}\t{1}'.format(t, s) for t, s in tl]) for tl in tracklist])
-    trl_file = os.path.join(outdir, '_tracklist.txt')
-    with open(trl_file, 'w') as f:
-        f.write(tracklisting)
-
-    echo('\n{0}', 'The new pablo track just dropped ~ (done)')
+def _make_mixes(mixes, jobs=None):
+    """
+    Makes mixes across a pool of `jobs` processes (by default, one per CPU),
+    yielding `(mix_dir, seed, mix_file, error)` for each as it's done.
+    A mix which fails doesn't stop the others.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), len(mixes)))
+    try:
+        for result in pool.imap_unordered(_make_mix, mixes):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def _make_mix(args):
+    from pablo import pipeline
+    args, kwargs = args
+    mix_dir, seed = args[2], kwargs.get('seed')
+    try:
+        return mix_dir, seed, pipeline.make_mix(*args, **kwargs), None
+    except Exception as e:
+        return mix_dir, seed, None, '{0}: {1}'.format(type(e).__name__, e)
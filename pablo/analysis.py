@@ -3,10 +3,40 @@ I don't really understand any of this, most
 of this is adapted from Essentia's examples.
 """
 
+import wave
+import subprocess
 import numpy as np
+from collections import namedtuple
+import multiprocessing
 from pablo.models.key import Key
-from pablo.datastore import save, load
-from essentia import Pool, run, standard, streaming
+from pablo.datastore import save, save_many, load, load_many, load_beats
+from essentia import Pool, run, streaming
+import essentia
+essentia.log.warningActive = False
+
+
+FEATURES = ('bpm', 'key', 'beats', 'bands', 'danceability', 'duration')
+
+# The features which are saved for every analyzed song
+ANALYSIS_FEATURES = ('bpm', 'key', 'beats', 'duration')
+
+# How many analyses `analyze_many` saves at once
+SAVE_BATCH_SIZE = 16
+
+# Frequency band edges (Hz) used to guess a song's main band
+BANDS = [0, 250, 750, 4000]
+
+
+class Analysis(namedtuple('Analysis', FEATURES + ('beats_confidence',))):
+    """
+    The results of a single analysis pass over an audio file.
+    Features which weren't requested are None.
+    """
+    @property
+    def main_band(self):
+        if self.bands is None:
+            return None
+        return _main_band(self.bands)
 
 
 def analyze(infile):
@@ -20,84 +50,210 @@ def analyze(infile):
         bpm, key, scale = data
         return bpm, Key(key, scale)
 
-    bpm = estimate_bpm(infile)
-    key = estimate_key(infile)
-    save(infile, bpm, key)
+    result = _analyze(infile)
+    return result.bpm, result.key
 
-    return bpm, key
 
+def beat_grid(infile):
+    """
+    Returns a song's beats (in seconds), the beat tracker's
+    confidence in them, and the song's duration (in seconds).
 
-def estimate_bpm(infile):
+    The beat grid is saved along with the song's analysis, so it's
+    only tracked if the song was analyzed before grids were kept.
     """
-    Estimates the BPM for an audio file.
+    grid = load_beats(infile)
+    if grid is not None:
+        return grid
+
+    result = _analyze(infile)
+    return result.beats, result.beats_confidence, result.duration
+
+
+def _analyze(infile):
     """
-    pool = Pool()
+    Analyzes and saves a song. The beats come out of
+    the same pass as the bpm, so they're kept too.
+    """
+    result = extract(infile, features=ANALYSIS_FEATURES)
+    save(infile, *_row(result))
+    return result
 
-    loader = streaming.MonoLoader(filename=infile)
-    bt = streaming.RhythmExtractor2013()
-    bpm_histogram = streaming.BpmHistogramDescriptors()
-    centroid = streaming.Centroid(range=250) # BPM histogram output size is 250
-
-    loader.audio >> bt.signal
-    bt.bpm >> (pool, 'bpm')
-    bt.ticks >> None
-    bt.confidence >> (pool, 'confidence')
-    bt.estimates >> None
-    bt.bpmIntervals >> bpm_histogram.bpmIntervals
-    bpm_histogram.firstPeakBPM >> (pool, 'bpm_first_peak')
-    bpm_histogram.firstPeakWeight >> None
-    bpm_histogram.firstPeakSpread >> None
-    bpm_histogram.secondPeakBPM >> (pool, 'bpm_second_peak')
-    bpm_histogram.secondPeakWeight >> None
-    bpm_histogram.secondPeakSpread >> None
-    bpm_histogram.histogram >> (pool, 'bpm_histogram')
-    bpm_histogram.histogram >> centroid.array
-    centroid.centroid >> (pool, 'bpm_centroid')
 
-    run(loader)
-    return pool['bpm']
+def analyze_many(files, jobs=1):
+    """
+    Analyzes files across a pool of `jobs` processes
+    (`jobs=None` uses one process per CPU).
 
+    Workers only extract features; the analyses are persisted
+    by this (the calling) process as they come in, so the workers
+    never write to the datastore (though other threads, e.g. `pablo dig`'s
+    downloads, may, see `datastore.connect`). Analyses are saved in
+    small batches, so an interrupted run can be resumed by passing
+    only the `pending` files.
 
-def estimate_key(infile):
+    Yields `(file, bpm, key)` in order of completion.
+    If a file couldn't be analyzed, `bpm` and `key` are None.
     """
-    Estimates the key and scale for an audio file.
+    if jobs == 1:
+        results = (_extract(f) for f in files)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_extract, files)
+
+    batch = []
+    try:
+        for infile, result in results:
+            if result is None:
+                yield infile, None, None
+                continue
+            batch.append((infile,) + _row(result))
+            if len(batch) >= SAVE_BATCH_SIZE:
+                save_many(batch)
+                batch = []
+            yield infile, result.bpm, result.key
+    finally:
+        if batch:
+            save_many(batch)
+        if jobs != 1:
+            pool.terminate()
+
+
+def pending(files, progress=None):
     """
-    loader = streaming.MonoLoader(filename=infile)
-    framecutter = streaming.FrameCutter()
-    windowing = streaming.Windowing(type="blackmanharris62")
-    spectrum = streaming.Spectrum()
-    spectralpeaks = streaming.SpectralPeaks(orderBy="magnitude",
-                                magnitudeThreshold=1e-05,
-                                minFrequency=40,
-                                maxFrequency=5000,
-                                maxPeaks=10000)
+    Returns the files which haven't been analyzed yet.
+
+    Files have to be hashed to be looked up, which takes a while for
+    a library that hasn't been seen before; `progress` (if given)
+    is called with each file once it's been looked up.
+    """
+    return [f for f, data in zip(files, load_many(files, progress=progress)) if data is None]
+
+
+def _extract(infile):
+    """
+    Worker for `analyze_many`.
+    """
+    try:
+        return infile, extract(infile, features=ANALYSIS_FEATURES)
+    except Exception:
+        return infile, None
+
+
+def _row(result):
+    """
+    The values of an `Analysis` that get saved, see `datastore.save_many`.
+    """
+    return (result.bpm, result.key, result.beats,
+            result.beats_confidence, result.duration)
+
+
+def extract(infile, features=FEATURES):
+    """
+    Extracts the requested features from an audio file
+    in a single pass, i.e. the file is decoded only once
+    and the decoded audio is fanned out to each of the extractors.
+
+    Returns an `Analysis`.
+    """
+    features = set(features)
+    unknown = features - set(FEATURES)
+    if unknown:
+        raise ValueError('Unknown features: {0}'.format(', '.join(sorted(unknown))))
+
     pool = Pool()
-    hpcp = streaming.HPCP()
-    key = streaming.Key()
-
-    loader.audio >> framecutter.signal
-    framecutter.frame >> windowing.frame >> spectrum.frame
-    spectrum.spectrum >> spectralpeaks.spectrum
-    spectralpeaks.magnitudes >> hpcp.magnitudes
-    spectralpeaks.frequencies >> hpcp.frequencies
-    hpcp.hpcp >> key.pcp
-    key.key >> (pool, 'tonal.key_key')
-    key.scale >> (pool, 'tonal.key_scale')
-    key.strength >> (pool, 'tonal.key_strength')
+    loader = streaming.MonoLoader(filename=infile)
+
+    # Tempo and beats come out of the same rhythm extractor
+    if features & {'bpm', 'beats'}:
+        rhythm = streaming.RhythmExtractor2013()
+        loader.audio >> rhythm.signal
+        rhythm.bpm >> (pool, 'bpm')
+        rhythm.ticks >> (pool, 'beats')
+        rhythm.confidence >> (pool, 'beats_confidence')
+        rhythm.estimates >> None
+        rhythm.bpmIntervals >> None
+
+    # Key and bands share the same spectrum
+    if features & {'key', 'bands'}:
+        framecutter = streaming.FrameCutter()
+        windowing = streaming.Windowing(type="blackmanharris62")
+        spectrum = streaming.Spectrum()
+        loader.audio >> framecutter.signal
+        framecutter.frame >> windowing.frame >> spectrum.frame
+
+        if 'key' in features:
+            spectralpeaks = streaming.SpectralPeaks(orderBy="magnitude",
+                                        magnitudeThreshold=1e-05,
+                                        minFrequency=40,
+                                        maxFrequency=5000,
+                                        maxPeaks=10000)
+            hpcp = streaming.HPCP()
+            key = streaming.Key()
+            spectrum.spectrum >> spectralpeaks.spectrum
+            spectralpeaks.magnitudes >> hpcp.magnitudes
+            spectralpeaks.frequencies >> hpcp.frequencies
+            hpcp.hpcp >> key.pcp
+            key.key >> (pool, 'tonal.key_key')
+            key.scale >> (pool, 'tonal.key_scale')
+            key.strength >> (pool, 'tonal.key_strength')
+
+        if 'bands' in features:
+            freqbands = streaming.FrequencyBands(frequencyBands=BANDS)
+            spectrum.spectrum >> freqbands.spectrum
+            freqbands.bands >> (pool, 'bands')
+
+    if 'danceability' in features:
+        dance = streaming.Danceability()
+        loader.audio >> dance.signal
+        dance.danceability >> (pool, 'danceability')
+        # Only in newer versions of Essentia
+        if 'dfa' in dance.outputNames():
+            dance.dfa >> None
+
+    if 'duration' in features:
+        dur = streaming.Duration()
+        loader.audio >> dur.signal
+        dur.duration >> (pool, 'duration')
 
     run(loader)
 
-    return Key(pool['tonal.key_key'], pool['tonal.key_scale'])
+    results = dict.fromkeys(Analysis._fields)
+    if 'bpm' in features:
+        results['bpm'] = pool['bpm']
+    if 'beats' in features:
+        results['beats'] = pool['beats']
+        results['beats_confidence'] = pool['beats_confidence']
+    if 'key' in features:
+        results['key'] = Key(pool['tonal.key_key'], pool['tonal.key_scale'])
+    if 'bands' in features:
+        results['bands'] = np.sum(pool['bands'], axis=0)
+    if 'danceability' in features:
+        results['danceability'] = pool['danceability']
+    if 'duration' in features:
+        results['duration'] = pool['duration']
+    return Analysis(**results)
+
+
+def estimate_bpm(infile):
+    """
+    Estimates the BPM for an audio file.
+    """
+    return extract(infile, features=('bpm',)).bpm
+
+
+def estimate_key(infile):
+    """
+    Estimates the key and scale for an audio file.
+    """
+    return extract(infile, features=('key',)).key
 
 
 def estimate_beats(infile):
     """
     Return the estimated beat onsets in seconds for an audio file.
     """
-    audio = standard.MonoLoader(filename=infile)()
-    bt = standard.BeatTrackerMultiFeature()
-    beats, confidence = bt(audio)
-    return beats
+    return extract(infile, features=('beats',)).beats
 
 
 def estimate_main_band(infile):
@@ -107,48 +263,53 @@ def estimate_main_band(infile):
     Not _really_ sure if this does what I need it to,
     but some quick tests looked right.
     """
-    loader = streaming.MonoLoader(filename=infile)
-    framecutter = streaming.FrameCutter()
-    windowing = streaming.Windowing(type="blackmanharris62")
-    spectrum = streaming.Spectrum()
-    freqbands = streaming.FrequencyBands(frequencyBands=[0, 250, 750, 4000])
-    pool = Pool()
+    return extract(infile, features=('bands',)).main_band
 
-    loader.audio >> framecutter.signal
-    framecutter.frame >> windowing.frame >> spectrum.frame
-    spectrum.spectrum >> freqbands.spectrum
-    freqbands.bands >> (pool, 'bands')
 
-    run(loader)
+def estimate_danceability(infile):
+    return extract(infile, features=('danceability',)).danceability
 
-    sums = np.sum(pool['bands'], axis=0)
-    band = np.argmax(sums)
-    if band == 0:
-        return 'low'
-    elif band == 1:
-        return 'mid'
-    elif band == 2:
-        return 'high'
 
+def duration(infile):
+    """
+    Returns the duration of a song in seconds.
+    """
+    return extract(infile, features=('duration',)).duration
 
-def estimate_danceability(infile):
-    loader = streaming.MonoLoader(filename=infile)
-    dance = streaming.Danceability()
-    pool = Pool()
 
-    loader.audio >> dance.signal
-    dance.danceability >> (pool, 'danceability')
+def probe_duration(infile):
+    """
+    Returns the duration of an audio file in seconds,
+    from its header rather than by decoding it.
+    """
+    if infile.lower().endswith('.wav'):
+        f = wave.open(infile, 'rb')
+        try:
+            return f.getnframes()/float(f.getframerate())
+        finally:
+            f.close()
 
-    run(loader)
+    try:
+        output = subprocess.check_output([
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1',
+            infile
+        ])
+        return float(output.strip())
 
-    return pool['danceability']
+    # Fall back to decoding if ffprobe isn't available
+    # or can't make sense of the file
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return duration(infile)
 
 
-def duration(infile):
-    """
-    Returns the duration of a song in seconds.
-    """
-    dur = standard.Duration()
-    audio = standard.MonoLoader(filename=infile)()
-    duration = dur(audio)
-    return duration
+def _main_band(bands):
+    band = np.argmax(bands)
+    if band == 0:
+        return 'low'
+    elif band == 1:
+        return 'mid'
+    elif band == 2:
+        return 'high'
@@ -0,0 +1,78 @@
+"""
+A cache of processed (i.e. key shifted, tempo stretched, trimmed) songs,
+so songs don't have to be re-processed for every mix.
+
+Processed songs are stored along with their beats,
+and are keyed by their source file's contents and how they were processed.
+The least recently used songs are evicted to keep the cache under a size budget.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from pablo import datastore
+
+cache_dir = os.path.join(datastore.pablo_dir, 'cache')
+
+# Default size budget, in bytes
+MAX_SIZE = 2 * 1024**3
+
+
+def key(infile, transforms, backend, ext):
+    """
+    The cache key for a song processed with the given transforms
+    (see `pablo.mutate.process`) and backend, saved in the given format.
+    """
+    params = [datastore.fingerprint(infile), backend, ext.strip('.'),
+              [(name, value) for name, value in transforms if name != 'click']]
+    return hashlib.sha1(json.dumps(params).encode('utf8')).hexdigest()
+
+
+def get(key, outfile):
+    """
+    Copies the cached song for this key (if there is one) to `outfile`.
+    Returns its beats, or None if it isn't cached.
+    """
+    render = datastore.load_render(key)
+    if render is None:
+        return None
+
+    path, beats = render
+    try:
+        shutil.copy(path, outfile)
+    except (IOError, OSError):
+        return None
+    return beats
+
+
+def put(key, infile, beats, max_size=MAX_SIZE):
+    """
+    Caches a processed song and its beats, evicting
+    the least recently used songs if the cache is too big.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Copy to a temporary file first so other processes
+    # never see a partially written file
+    _, ext = os.path.splitext(infile)
+    path = os.path.join(cache_dir, '{0}{1}'.format(key, ext))
+    tmpfile = '{0}.{1}.tmp'.format(path, os.getpid())
+    shutil.copy(infile, tmpfile)
+    os.rename(tmpfile, path)
+
+    datastore.save_render(key, path, beats)
+    evict(max_size)
+
+
+def evict(max_size=MAX_SIZE):
+    """
+    Evicts the least recently used songs until the cache
+    is at most `max_size` bytes.
+    """
+    for path in datastore.evict_renders(max_size):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
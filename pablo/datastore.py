@@ -1,28 +1,421 @@
 import os
+import json
+import time
 import sqlite3
 import hashlib
+import threading
+from contextlib import contextmanager
 
 pablo_dir = os.path.expanduser('~/.pablo')
-if not os.path.exists(pablo_dir):
-    os.makedirs(pablo_dir)
 db_file = os.path.join(pablo_dir, 'songs.db')
 
-conn = sqlite3.connect(db_file)
-c = conn.cursor()
-c.execute('CREATE TABLE IF NOT EXISTS songs (hash text, bpm real, key text, scale text)')
+# Read files in chunks of this many bytes when hashing
+CHUNK_SIZE = 1024 * 1024
 
-def save(filename, bpm, key):
-    hash = _hash(filename)
-    c.execute('INSERT INTO songs VALUES (?, ?, ?, ?)', (hash, bpm, key.key, key.scale))
-    conn.commit()
+# How long (in seconds) to wait on another process's lock
+# before giving up with "database is locked"
+TIMEOUT = 30
+
+# SQLite limits the number of parameters per query,
+# so bulk lookups are done in batches of this size
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+def connect():
+    """
+    Returns a connection to the datastore, creating and
+    migrating the database if necessary.
+
+    Connections aren't shared across processes or threads,
+    so each gets its own, opened on first use.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key == (os.getpid(), db_file):
+        return conn
+
+    dirname = os.path.dirname(db_file)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    # Transactions are managed explicitly, see `_transaction`
+    conn = sqlite3.connect(db_file, timeout=TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = {0}'.format(TIMEOUT * 1000))
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    _migrate(conn)
+
+    _local.conn = conn
+    _local.key = (os.getpid(), db_file)
+    return conn
+
+
+def close():
+    """
+    Closes this thread's connection, if there is one.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        if _local.key[0] == os.getpid():
+            conn.close()
+        _local.conn = None
+
+
+def save(filename, bpm, key, beats=None, beats_confidence=None, duration=None):
+    save_many([(filename, bpm, key, beats, beats_confidence, duration)])
+
+
+def save_many(analyses):
+    """
+    Saves analyses in a single transaction.
+
+    Analyses should be in the form:
+
+        [(filename, bpm, key), ...]
+
+    or, to also save the song's beat grid (see `load_beats`):
+
+        [(filename, bpm, key, beats, beats_confidence, duration), ...]
+    """
+    hashes = fingerprint_many([a[0] for a in analyses])
+    rows = []
+    for hash, analysis in zip(hashes, analyses):
+        _, bpm, key = analysis[:3]
+        beats, confidence, duration = (tuple(analysis[3:]) + (None,) * 3)[:3]
+        if beats is not None:
+            beats = json.dumps([float(b) for b in beats])
+        rows.append((hash, bpm, key.key, key.scale, beats, confidence, duration))
+    with _transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO songs (hash, bpm, key, scale, beats, beats_confidence, duration) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
 
 
 def load(filename):
-    hash = _hash(filename)
-    return c.execute('SELECT bpm, key, scale FROM songs WHERE (hash = ?)', (hash,)).fetchone()
+    return load_many([filename])[0]
+
+
+def load_many(filenames, progress=None):
+    """
+    Loads the analyses for the given files.
+    `progress` is as for `fingerprint_many`.
+
+    Returns a list of `(bpm, key, scale)` in the same order as the
+    filenames, with None for files which haven't been analyzed.
+    """
+    hashes = fingerprint_many(filenames, progress=progress)
+    analyses = load_hashes(hashes)
+    return [analyses.get(hash) for hash in hashes]
+
+
+def load_hashes(hashes):
+    """
+    Loads analyses by file hash.
+
+    Returns a dict of `{hash: (bpm, key, scale)}`;
+    hashes which haven't been analyzed are left out.
+    """
+    rows = _select_in('SELECT hash, bpm, key, scale FROM songs WHERE hash IN ({0})', set(hashes))
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def load_beats(filename):
+    """
+    Loads a song's beat grid, i.e. its beats (in seconds),
+    the beat tracker's confidence in them, and the song's duration.
+
+    Returns `(beats, beats_confidence, duration)`, or None
+    if the song hasn't been analyzed or was analyzed without its beats.
+    """
+    row = connect().execute('SELECT beats, beats_confidence, duration FROM songs WHERE (hash = ?) AND beats IS NOT NULL',
+                            (fingerprint(filename),)).fetchone()
+    if row is None:
+        return None
+    beats, confidence, duration = row
+    return json.loads(beats), confidence, duration
+
+
+def find(bpm_range, keys=None):
+    """
+    Finds analyses with a bpm in the (inclusive) range `(lower, upper)`
+    and, if specified, one of the given `keys`, e.g. `[('C', 'major'), ...]`.
+
+    Returns a list of `(hash, bpm, key, scale)`.
+    """
+    query = 'SELECT hash, bpm, key, scale FROM songs WHERE bpm BETWEEN ? AND ?'
+    params = list(bpm_range)
+    if keys is not None:
+        keys = list(keys)
+        if not keys:
+            return []
+        query += ' AND ({0})'.format(' OR '.join('(key = ? AND scale = ?)' for _ in keys))
+        params += [v for k in keys for v in k]
+    return connect().execute(query, params).fetchall()
+
+
+def fingerprint(filename):
+    return fingerprint_many([filename])[0]
+
+
+def fingerprint_many(filenames, progress=None):
+    """
+    Returns the content hashes of files, in the same order.
+
+    Hashes are remembered against each file's path, size, mtime and inode,
+    so a file is only read (and re-hashed) if one of those has changed.
+    Hashing a large library for the first time takes a while,
+    so `progress` (if given) is called with each file once it's done,
+    and new hashes are saved as they go, so an interrupted run keeps them.
+    """
+    paths = [os.path.abspath(f) for f in filenames]
+    rows = _select_in('SELECT path, size, mtime, inode, hash FROM fingerprints WHERE path IN ({0})', set(paths))
+    known = {row[0]: (tuple(row[1:4]), row[4]) for row in rows}
+
+    hashes = []
+    updates = []
+    for path in paths:
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime, stat.st_ino)
+        stat_key, hash = known.get(path, (None, None))
+        if stat_key != key:
+            hash = _hash(path)
+            known[path] = (key, hash)
+            updates.append((path,) + key + (hash,))
+        hashes.append(hash)
+        if progress is not None:
+            progress(path)
+        if len(updates) >= BATCH_SIZE:
+            _save_fingerprints(updates)
+            updates = []
+
+    if updates:
+        _save_fingerprints(updates)
+    return hashes
+
+
+def load_render(key):
+    """
+    Loads a cached render (see `pablo.cache`) and marks it as used.
+    Returns `(path, beats)` or None.
+    """
+    with _transaction() as conn:
+        row = conn.execute('SELECT path, beats FROM renders WHERE (key = ?)', (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE renders SET used = ? WHERE (key = ?)', (time.time(), key))
+    path, beats = row
+    return path, json.loads(beats)
+
+
+def save_render(key, path, beats):
+    size = os.path.getsize(path)
+    with _transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?, ?)',
+                     (key, path, size, json.dumps([float(b) for b in beats]), time.time()))
+
+
+def evict_renders(max_size):
+    """
+    Removes the least recently used renders from the index
+    until they total at most `max_size` bytes.
+    Returns the paths of the removed renders.
+    """
+    with _transaction() as conn:
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM renders').fetchone()[0]
+        evicted = []
+        for key, path, size in conn.execute('SELECT key, path, size FROM renders ORDER BY used').fetchall():
+            if total <= max_size:
+                break
+            evicted.append((key, path))
+            total -= size
+        conn.executemany('DELETE FROM renders WHERE (key = ?)', [(key,) for key, _ in evicted])
+    return [path for _, path in evicted]
+
+
+def load_features(hashes):
+    """
+    Loads the Spotify lookups (see `pablo.spotify`) for the given file hashes.
+
+    Returns a dict of `{hash: (track, features)}`, where `track` is None
+    if the song couldn't be found; hashes which haven't been looked up are left out.
+    """
+    rows = _select_in('SELECT hash, track, features FROM features WHERE hash IN ({0})', set(hashes))
+    return {hash: (_loads(track), _loads(features)) for hash, track, features in rows}
+
+
+def save_features(lookups):
+    """
+    Saves Spotify lookups, in the form:
+
+        [(hash, track, features), ...]
+    """
+    rows = [(hash, _dumps(track), _dumps(features), time.time()) for hash, track, features in lookups]
+    with _transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)', rows)
+
+
+def load_downloads(video_ids):
+    """
+    Loads what's known about videos from earlier digs (see `pablo.diglet`).
+
+    Returns a dict of `{video_id: (hash, path, status, duration)}`;
+    videos which haven't been seen before are left out.
+    """
+    rows = _select_in('SELECT video_id, hash, path, status, duration FROM downloads WHERE video_id IN ({0})', set(video_ids))
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def save_downloads(downloads):
+    """
+    Records what happened to videos, in the form:
+
+        [(video_id, hash, path, status, duration), ...]
+    """
+    rows = [tuple(d) + (time.time(),) for d in downloads]
+    with _transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+def known_hash(hash, path=None):
+    """
+    Whether there's still a file with this content hash (e.g. one which was
+    downloaded, or analyzed) at a path other than `path`. Only identical
+    files have the same hash, so this doesn't find the same song encoded
+    differently.
+    """
+    path = os.path.abspath(path) if path is not None else None
+    rows = connect().execute('SELECT path FROM fingerprints WHERE (hash = ?) UNION SELECT path FROM downloads WHERE (hash = ?)',
+                             (hash, hash)).fetchall()
+    paths = [p for p, in rows if p is not None and p != path and os.path.exists(p)]
+
+    # Check the files haven't changed since
+    return hash in fingerprint_many(paths)
+
+
+def _dumps(obj):
+    return json.dumps(obj) if obj is not None else None
+
+
+def _loads(text):
+    return json.loads(text) if text is not None else None
+
+
+def _save_fingerprints(rows):
+    with _transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)', rows)
 
 
 def _hash(filename):
+    md5 = hashlib.md5()
     with open(filename, 'rb') as f:
-        data = f.read()
-    return hashlib.md5(data).hexdigest()
\ No newline at end of file
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _select_in(query, values):
+    """
+    Runs a `... IN ({0})` query over values in batches.
+    """
+    conn = connect()
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), BATCH_SIZE):
+        batch = values[i:i+BATCH_SIZE]
+        placeholders = ', '.join('?' for _ in batch)
+        rows += conn.execute(query.format(placeholders), batch).fetchall()
+    return rows
+
+
+@contextmanager
+def _transaction(conn=None):
+    """
+    Wraps a write in a transaction. The write lock is taken up front
+    so that concurrent writers wait on the busy timeout instead of failing.
+    """
+    conn = conn or connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _tables(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+
+def _v1(conn):
+    """
+    Key songs by their hash. Earlier databases had no key on songs,
+    so they may have duplicate analyses; the latest analysis is kept.
+    """
+    if 'songs' in _tables(conn):
+        conn.execute('ALTER TABLE songs RENAME TO songs_old')
+        conn.execute('CREATE TABLE songs (hash text PRIMARY KEY, bpm real, key text, scale text)')
+        conn.execute('INSERT OR IGNORE INTO songs SELECT hash, bpm, key, scale FROM songs_old ORDER BY rowid DESC')
+        conn.execute('DROP TABLE songs_old')
+    else:
+        conn.execute('CREATE TABLE songs (hash text PRIMARY KEY, bpm real, key text, scale text)')
+    conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (path text PRIMARY KEY, size integer, mtime real, inode integer, hash text)')
+
+
+def _v2(conn):
+    """
+    Index songs by bpm for library queries.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS songs_bpm ON songs (bpm)')
+
+
+def _v3(conn):
+    """
+    Index of processed songs, see `pablo.cache`.
+    """
+    conn.execute('CREATE TABLE renders (key text PRIMARY KEY, path text, size integer, beats text, used real)')
+    conn.execute('CREATE INDEX renders_used ON renders (used)')
+
+
+def _v4(conn):
+    """
+    Keep songs' beat grids, so processed songs' beats
+    can be worked out instead of tracked again.
+    """
+    conn.execute('ALTER TABLE songs ADD COLUMN beats text')
+    conn.execute('ALTER TABLE songs ADD COLUMN beats_confidence real')
+    conn.execute('ALTER TABLE songs ADD COLUMN duration real')
+
+
+def _v5(conn):
+    """
+    Cache of Spotify lookups, see `pablo.spotify`.
+    """
+    conn.execute('CREATE TABLE features (hash text PRIMARY KEY, track text, features text, updated real)')
+
+
+def _v6(conn):
+    """
+    Index of downloaded (or skipped) videos, see `pablo.diglet`,
+    and look up files by their contents to dedupe downloads.
+    """
+    conn.execute('CREATE TABLE downloads (video_id text PRIMARY KEY, hash text, path text, status text, duration real, updated real)')
+    conn.execute('CREATE INDEX downloads_hash ON downloads (hash)')
+    conn.execute('CREATE INDEX fingerprints_hash ON fingerprints (hash)')
+
+
+# Schema migrations, in order.
+# The database's `user_version` is the number of migrations applied to it.
+MIGRATIONS = [_v1, _v2, _v3, _v4, _v5, _v6]
+
+
+def _migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == len(MIGRATIONS):
+        return
+
+    with _transaction(conn):
+        # Check again in case another process migrated in the meantime
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            migration(conn)
+        conn.execute('PRAGMA user_version = {0}'.format(len(MIGRATIONS)))
@@ -1,68 +1,337 @@
 import os
+import time
+import threading
 import requests
+from colorama import Fore
 from lxml.html import fromstring
-from youtube_dl import YoutubeDL
+from multiprocessing.pool import ThreadPool
 
+from pablo import datastore
 
-base = 'https://www.youtube.com'
+try:
+    from queue import Queue
+    from urllib.parse import urljoin, urlparse, parse_qs
+except ImportError:
+    from Queue import Queue
+    from urlparse import urljoin, urlparse, parse_qs
 
 
-def dig(start, outdir, depth=2, max_duration=360):
+# How many pages to fetch at once
+JOBS = 8
+
+# The most requests to make to any one host per second
+RATE = 5.
+
+# How long (in seconds) to wait on a page before giving up on it
+TIMEOUT = 10.
+
+# The formats downloads may be in (without transcoding, the
+# audio is kept in whichever of these YouTube serves it as)
+FORMATS = ('mp3', 'm4a', 'webm', 'opus', 'ogg')
+
+# YouTube video ids are this long
+ID_LENGTH = 11
+
+# What happened to a video (a duplicate is an identical
+# copy of a file which was already downloaded or analyzed,
+# and which is still around)
+DOWNLOADED = 'downloaded'
+DUPLICATE = 'duplicate'
+FILTERED = 'filtered'
+
+
+def dig(start, outdir, depth=2, max_duration=360, jobs=JOBS, transcode=True,
+        analyze=False, analysis_jobs=1, log=None):
     """
-    Crawls YouTube for source material (as mp3s).
+    Crawls YouTube for source material.
+
+    Videos which were downloaded, deduped or filtered out by
+    earlier digs (see `pending`) are skipped before downloading anything,
+    and downloads which turn out to be identical copies of files that
+    are still around are removed (see `record_download`).
+
+    With `analyze`, each song is analyzed as soon as it's downloaded
+    (see `analysis.analyze_many`), while the rest are still downloading,
+    as are songs from earlier digs which haven't been analyzed yet.
 
     Args:
         - start: the starting YouTube url
         - outdir: directory to save download tracks to
         - depth: how many levels of related vids to look through
         - max_duration: only dl videos shorter than or equal to this in duration
+        - jobs: how many pages to fetch at once
+        - transcode: whether to transcode downloads to mp3,
+          otherwise they're kept in their own format (see `FORMATS`)
+        - analyze: whether to analyze songs as they're downloaded
+        - analysis_jobs: how many songs to analyze at once (None for one per CPU)
+
+    Returns the urls which were skipped, as `(url, status)`.
     """
-    urls = [start]
-    candidates = [start]
+    log = log or _quiet
+    urls = crawl(start, depth=depth, jobs=jobs)
+    urls, skipped = pending(urls, outdir, max_duration=max_duration)
+    log('Got {0} videos ({1} already dug)', len(urls) + len(skipped), len(skipped))
+
+    if not analyze:
+        if urls:
+            _download(urls, outdir, max_duration, transcode)
+        return skipped
+
+    from pablo import analysis
+
+    # Downloads are handed over through this queue as they finish
+    queue = Queue()
+    errors = []
+    def download():
+        try:
+            if urls:
+                _download(urls, outdir, max_duration, transcode, downloaded=queue.put)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.put(None)
 
-    # Dig
-    while depth:
-        candidates = sum((_get_related_video_urls(url) for url in candidates), [])
-        urls += candidates
-        depth -= 1
+    thread = threading.Thread(target=download)
+    thread.daemon = True
 
-    # Remove dupes
-    urls = set(urls)
+    def songs():
+        # Downloading starts once the analysis workers (if any) are up,
+        # so they aren't forked along with the download thread
+        thread.start()
+        for f in analysis.pending(sorted(_existing(outdir).values())):
+            yield f
+        for f in iter(queue.get, None):
+            yield f
 
-    print('Got {0} videos'.format(len(urls)))
+    for f, bpm, key in analysis.analyze_many(songs(), jobs=analysis_jobs):
+        if bpm is None:
+            log('Could not analyze {0}', f, color=Fore.RED)
+        else:
+            log('Analyzed {0} ({1} bpm, {2} {3})', f, round(bpm, 1), key.key, key.scale)
 
+    thread.join()
+    if errors:
+        raise errors[0]
+    return skipped
+
+
+def _download(urls, outdir, max_duration, transcode=True, downloaded=None):
+    """
+    Downloads videos' audio, recording each (see `record_download`).
+    `downloaded` is called with the path of each new song.
+    """
     # Kind of peculiar how this function has to work
     def _filter(info):
         if info['duration'] > max_duration:
+            datastore.save_downloads([(info['id'], None, None, FILTERED, info['duration'])])
             return 'Too long'
         return None
 
     ydl_opts = {
         'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
+        'postprocessors': [],
         'match_filter': _filter,
         'outtmpl': os.path.join(outdir, '%(title)s-%(id)s.%(ext)s'),
     }
+    if transcode:
+        ydl_opts['postprocessors'].append({
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        })
+
+    from youtube_dl import YoutubeDL
     with YoutubeDL(ydl_opts) as ydl:
+        # Runs after the audio's been extracted
+        ydl.add_post_processor(_recorder()(ydl, downloaded))
         ydl.download(urls)
 
 
-def _get_related_video_urls(url, n=5):
-    r = requests.get(url)
+def pending(urls, outdir, max_duration=360):
+    """
+    Separates the videos which still need to be downloaded from those
+    which earlier digs downloaded (and which are still there),
+    found to be duplicates (of files which are still there),
+    or found to be longer than `max_duration`.
+
+    Videos already in `outdir` which aren't indexed yet (e.g. from before
+    there was an index) are indexed as downloaded.
+
+    Returns the urls to download, and the skipped urls as `(url, status)`.
+    """
+    ids = [video_id(url) for url in urls]
+    known = datastore.load_downloads(ids)
+    existing = _existing(outdir)
+
+    todo, skipped, found = [], [], []
+    for url, id in zip(urls, ids):
+        hash, path, status, duration = known.get(id, (None, None, None, None))
+        if status == DOWNLOADED and path is not None and os.path.exists(path) \
+                or status == DUPLICATE and datastore.known_hash(hash) \
+                or status == FILTERED and duration > max_duration:
+            skipped.append((url, status))
+        elif id in existing:
+            path = existing[id]
+            found.append((id, datastore.fingerprint(path), os.path.abspath(path), DOWNLOADED, None))
+            skipped.append((url, DOWNLOADED))
+        else:
+            todo.append(url)
+
+    if found:
+        datastore.save_downloads(found)
+    return todo, skipped
+
+
+def record_download(id, path):
+    """
+    Records a downloaded video. If it's an identical copy of a file which
+    is still around (see `datastore.known_hash`), it's removed,
+    and recorded as a duplicate.
+
+    Files are compared by their content hash, so the same song
+    encoded differently (e.g. from another upload) isn't caught.
+    Returns its status.
+    """
+    hash = datastore.fingerprint(path)
+    if datastore.known_hash(hash, path):
+        os.remove(path)
+        datastore.save_downloads([(id, hash, None, DUPLICATE, None)])
+        return DUPLICATE
+
+    datastore.save_downloads([(id, hash, os.path.abspath(path), DOWNLOADED, None)])
+    return DOWNLOADED
+
+
+def video_id(url):
+    """
+    The id of a YouTube video from its url.
+    """
+    url = urlparse(url)
+    ids = parse_qs(url.query).get('v')
+    return ids[0] if ids else url.path.rstrip('/').split('/')[-1]
+
+
+def _existing(outdir):
+    """
+    Videos which have been downloaded to `outdir`,
+    named as `<title>-<id>.<format>`, as `{id: path}`.
+    """
+    existing = {}
+    if not os.path.isdir(outdir):
+        return existing
+    for fname in os.listdir(outdir):
+        name, ext = os.path.splitext(fname)
+        if ext[1:] in FORMATS and len(name) > ID_LENGTH and name[-ID_LENGTH-1] == '-':
+            existing[name[-ID_LENGTH:]] = os.path.join(outdir, fname)
+    return existing
+
+
+def _recorder():
+    """
+    A youtube_dl post processor which records downloads
+    (see `record_download`). It's defined here so that
+    youtube_dl is only imported when downloading.
+    """
+    from youtube_dl.postprocessor.common import PostProcessor
+
+    class Recorder(PostProcessor):
+        def __init__(self, downloader=None, downloaded=None):
+            super(Recorder, self).__init__(downloader)
+            self.downloaded = downloaded
+
+        def run(self, info):
+            status = record_download(info['id'], info['filepath'])
+            if status == DOWNLOADED and self.downloaded is not None:
+                self.downloaded(info['filepath'])
+            return [], info
+
+    return Recorder
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def crawl(start, depth=2, jobs=JOBS, rate=RATE, n=5, timeout=TIMEOUT):
+    """
+    Crawls related videos breadth-first from `start`, `depth` levels deep,
+    following the top `n` related videos of each.
+
+    Each level's pages are fetched concurrently (across `jobs` threads,
+    sharing a pool of connections), and no page is fetched twice.
+    Requests to each host are limited to `rate` per second.
+    Pages which can't be fetched (within `timeout` seconds)
+    are skipped, i.e. treated as having no related videos.
+
+    Returns the unique video urls, in the order they were found.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    limiter = RateLimiter(rate)
+
+    def related(url):
+        limiter.wait(url)
+        try:
+            return _get_related_video_urls(url, n=n, session=session, timeout=timeout)
+        except requests.RequestException:
+            return []
+
+    urls = [start]
+    seen = set(urls)
+    frontier = [start]
+    pool = ThreadPool(jobs)
+    try:
+        while depth and frontier:
+            candidates = []
+            for related_urls in pool.map(related, frontier):
+                for url in related_urls:
+                    if url not in seen:
+                        seen.add(url)
+                        candidates.append(url)
+            urls += candidates
+            frontier = candidates
+            depth -= 1
+    finally:
+        pool.terminate()
+    return urls
+
+
+class RateLimiter():
+    """
+    Spaces out requests to each host so there
+    are at most `rate` per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1./rate if rate else 0
+        self.next = {}
+        self.lock = threading.Lock()
+
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next.get(host, now))
+            self.next[host] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def _get_related_video_urls(url, n=5, session=requests, timeout=TIMEOUT):
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
     html = fromstring(r.text)
 
     # Get the top 5 related videos
     results = []
     for el in html.cssselect('#watch-related .content-link')[:n]:
-        results.append(base + el.get('href'))
+        results.append(urljoin(url, el.get('href')))
 
     return results
 
 
 if __name__ == '__main__':
     start = 'https://www.youtube.com/watch?v=uS2nWLz-AbE'
-    dig(start, depth=2)
\ No newline at end of file
+    dig(start, depth=2)
@@ -0,0 +1,131 @@
+"""
+In-memory audio processing, as an alternative to sox.
+
+Audio is handled as arrays of shape `(n_samples, n_channels)`.
+"""
+
+import numpy as np
+
+
+def stretch(audio, ratio=None, length=None, frame_size=2048, hop=512, batch_size=512):
+    """
+    Time-stretches audio without changing its pitch, with a phase vocoder.
+
+    Either specify a `ratio` (the change in tempo, i.e. `ratio > 1` speeds up)
+    or the exact `length` (in samples) the audio should be stretched to.
+
+    Frames are processed in batches of `batch_size`, so memory use
+    doesn't depend on the length of the audio.
+    """
+    if length is None:
+        length = int(round(len(audio)/float(ratio)))
+    if length == len(audio):
+        return audio.copy()
+    return np.stack([_stretch(audio[:,i], length, frame_size, hop, batch_size)
+                     for i in range(audio.shape[1])], axis=1)
+
+
+def shift(audio, semitones, frame_size=2048, hop=512, batch_size=512):
+    """
+    Pitch-shifts audio without changing its length,
+    by stretching it and then resampling it back to its original length.
+    """
+    if not semitones:
+        return audio.copy()
+    factor = 2**(semitones/12.)
+    stretched = stretch(audio, length=int(round(len(audio) * factor)),
+                        frame_size=frame_size, hop=hop, batch_size=batch_size)
+    return resample(stretched, len(audio))
+
+
+def resample(audio, length):
+    """
+    Resamples audio to exactly `length` samples (by linear interpolation).
+    """
+    x = np.linspace(0, len(audio) - 1, length)
+    xp = np.arange(len(audio))
+    return np.stack([np.interp(x, xp, audio[:,i]) for i in range(audio.shape[1])],
+                    axis=1).astype(audio.dtype)
+
+
+def trim_silence(audio, sample_rate, duration=0.1, threshold=0.01, window=10):
+    """
+    Removes silence from the beginning of audio, i.e. everything before
+    the first `duration` seconds which stay above `threshold` (of full scale),
+    measured as RMS over `window` ms.
+
+    Returns the trimmed audio and the number of samples trimmed.
+    """
+    window = max(1, int(sample_rate * window/1000.))
+    run = max(1, int(sample_rate * duration))
+
+    power = np.mean(audio.astype(np.float64)**2, axis=1)
+    csum = np.concatenate([[0], np.cumsum(power)])
+    rms = np.sqrt(np.maximum(csum[window:] - csum[:-window], 0)/window)
+    above = rms > threshold
+
+    # Find the first run of loud windows that is long enough
+    csum = np.concatenate([[0], np.cumsum(above)])
+    runs = np.flatnonzero(csum[run:] - csum[:-run] == run)
+    if not len(runs):
+        return audio[len(audio):], len(audio)
+    start = runs[0]
+    return audio[start:], start
+
+
+def _stretch(x, length, frame_size, hop, batch_size):
+    """
+    Stretches a single channel to `length` samples.
+    """
+    window = np.hanning(frame_size)
+    pad = frame_size//2
+    n = len(x)
+    x = np.concatenate([np.zeros(pad), x, np.zeros(frame_size + hop)])
+    n_in = 1 + (len(x) - frame_size)//hop
+    n_out = int(np.ceil(length/float(hop))) + 1
+
+    # Where in the input (in frames) each output frame is taken from
+    steps = np.arange(n_out) * (n/float(length))
+    steps = np.minimum(steps, n_in - 2)
+
+    # The expected phase advance per hop for each bin
+    advance = 2 * np.pi * hop * np.arange(frame_size//2 + 1)/frame_size
+
+    y = np.zeros((n_out - 1) * hop + frame_size)
+    envelope = np.zeros(len(y))
+    phase = None
+
+    for start in range(0, n_out, batch_size):
+        batch = steps[start:start+batch_size]
+        idx = batch.astype(int)
+        alpha = (batch - idx)[:,None]
+
+        # Only analyze the frames this batch needs
+        frames = np.fft.rfft(_frames(x, idx, frame_size, hop) * window, axis=1)
+        frames_ = np.fft.rfft(_frames(x, idx + 1, frame_size, hop) * window, axis=1)
+        mag = (1 - alpha) * np.abs(frames) + alpha * np.abs(frames_)
+
+        # Accumulate phase, continuing from the last batch
+        dphase = np.angle(frames_) - np.angle(frames) - advance
+        dphase = dphase - 2 * np.pi * np.round(dphase/(2 * np.pi)) + advance
+        if phase is None:
+            phase = np.angle(frames[0])
+        phases = phase + np.concatenate([np.zeros((1, len(advance))), np.cumsum(dphase[:-1], axis=0)])
+        phase = phases[-1] + dphase[-1]
+
+        # Overlap-add the synthesized frames
+        out = np.fft.irfft(mag * np.exp(1j * phases), n=frame_size, axis=1) * window
+        for i, frame in enumerate(out):
+            offset = (start + i) * hop
+            y[offset:offset+frame_size] += frame
+            envelope[offset:offset+frame_size] += window**2
+
+    y[envelope > 1e-8] /= envelope[envelope > 1e-8]
+    return y[pad:pad+length].astype(np.float32)
+
+
+def _frames(x, idx, frame_size, hop):
+    """
+    Returns the frames at the given frame indices.
+    """
+    return x[(idx * hop)[:,None] + np.arange(frame_size)]
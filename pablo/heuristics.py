@@ -1,8 +1,11 @@
 import random
+import numpy as np
 from collections import defaultdict
 from pablo.models.sample import Sample
-from pablo.analysis import estimate_main_band, duration
-from pydub import AudioSegment
+
+# How far apart (in seconds) slice durations can be
+# and still be considered the same, i.e. a few samples
+JITTER = 1e-4
 
 
 def eq(track_file):
@@ -25,6 +28,9 @@ def eq(track_file):
 
     This kinda sucks right now so not using it
     """
+    from pydub import AudioSegment
+    from pablo.analysis import estimate_main_band
+
     band = estimate_main_band(track_file)
     segm = AudioSegment.from_file(track_file)
 
@@ -34,27 +40,28 @@ def eq(track_file):
         return segm.low_pass_filter(250)
 
 
-def build_tracks(songs, length, n_tracks, coherent=True):
+def build_tracks(songs, length, n_tracks, coherent=True, transitions=None):
     """
     Builds multiple tracks so that samples from the same song
     are never playing simultaneously.
-    """
-    # Build the first track
-    track = build_bar(songs, length, coherent=coherent)
 
-    # Convert to a flattened list of slices
-    track = sum([s.slices for s in track], ())
+    `transitions` optionally overrides the weights of
+    the moves between samples, see `TRANSITIONS`.
 
-    tracks = [track]
-    for i in range(n_tracks-1):
-        track_ = build_bar(songs, length, coherent=coherent, tracks=tracks)
-        track_ = sum([s.slices for s in track_], ())
-        tracks.append(track_)
+    Returns each track as a list of slices.
+    """
+    arrangement = Arrangement(songs, length, n_tracks, transitions=transitions)
+    tracks = []
+    for i in range(n_tracks):
+        track = arrangement.build_bar(i, length, coherent=coherent)
+
+        # Convert to a flattened list of slices
+        tracks.append([slice for sample in track for slice in sample.slices])
 
     return tracks
 
 
-def build_bar(songs, n, prev_sample=None, coherent=True, tracks=[], bar_position=0, recur=0):
+def build_bar(songs, n, prev_sample=None, coherent=True, tracks=[], bar_position=0):
     """
     Builds a bar of n beats in length,
     where n >= the shortest sample length.
@@ -80,95 +87,251 @@ def build_bar(songs, n, prev_sample=None, coherent=True, tracks=[], bar_position
     This assumes that the samples are in their chronological sequence.
     That is, that samples i and i+1 for a song are temporally adjacent.
 
+    The bar won't use songs which are playing in any of the `tracks`
+    (each a list of slices) over the length of the bar, which starts
+    `bar_position` slices in.
+
     Returns a list of Samples.
     """
-    if len(tracks) > len(songs):
-        raise Exception('Must have more songs available than overlaid tracks')
-
-    # Remove any songs which are simultaneously playing in other tracks
-    # over the length of this bar
     min_size = min(s.min_size for s in songs)
-    invalid_songs = []
-    for track in tracks:
-        for i in range(n/min_size):
-            invalid_songs.append(track[bar_position+i].song)
-    valid_songs = [s for s in songs if s not in invalid_songs]
-
-    # ugh, well we can overlap songs, I _guess_...
-    if not valid_songs:
-        valid_songs = [random.choice(songs)]
-
-    # Find samples of length n
-    full_bar_samples = {}
-    for song in valid_songs:
-        if n in song.sizes:
-            full_bar_samples[song.name] = [s for s in song[n] if s is not None]
-
-    min_size = min(s.min_size for s in valid_songs)
-
-    if n < min_size:
-        raise Exception('Can\'t create a bar shorter than the shortest sample')
-
-    # If this is the smallest sample size,
-    # we can only return full bars.
-    # Otherwise, slightly favor complete bars, if available
-    if n == min_size or (full_bar_samples and random.random() <= 0.6):
-        if coherent:
-            return _select_sample(full_bar_samples, n, prev_sample)
-        else:
-            song = random.choice(full_bar_samples.keys())
-            return random.choice(full_bar_samples[song])
-
-    # Otherwise, assemble the bar from sub-bars
-    bar = []
-    length = 0
-    while length < n:
-        n_ = n/2
-        bar += build_bar(songs, n_, prev_sample=prev_sample, bar_position=bar_position, tracks=tracks)
-        bar_position += n_/min_size
-        length += n_
-        prev_sample = bar[-1]
-
-    return bar
-
-
-def _select_sample(samples, length, prev_sample):
-    """
-    Selects a sample via a markov chain
+    n_slots = max([len(t) for t in tracks] + [bar_position + n//min_size])
 
-    Samples should be in the form:
+    arrangement = Arrangement(songs, n_slots * min_size, len(tracks) + 1)
+    for i, track in enumerate(tracks):
+        arrangement.occupancy[i, :len(track)] = [arrangement.index[s.song.name] for s in track]
+    return arrangement.build_bar(len(tracks), n, bar_position=bar_position,
+                                 prev_sample=prev_sample, coherent=coherent)
 
-        {
-            'song_name': [ ... samples ... ],
-            ...
-        }
-    """
-    if prev_sample is not None:
-        song = prev_sample.song
 
-        # Repeat the sample (if it is of the needed length)
-        if prev_sample.size == length and random.random() <= 0.3:
-            return [prev_sample]
+# How likely a coherent track is to move from one sample to:
+# - the same sample again (if it's the right size)
+# - the next sample in its song
+# - a random sample from a random song
+# Where a move isn't possible, the others are scaled up to make up for it
+TRANSITIONS = {'repeat': 0.3, 'next': 0.525, 'random': 0.175}
+
+# How likely a bar is to be filled with a full sample,
+# rather than two sub-bars, if it can be
+FULL_BAR = 0.6
+
+# How many random songs to try before checking
+# every song to find one which isn't playing
+MAX_TRIES = 8
 
-        # Play the next chronological sample from the song (if available)
-        if random.random() <= 0.75:
-            next_sample = song.next_sample(prev_sample, length)
-            if next_sample is not None:
-                return [next_sample]
 
-    # Otherwise, return a random sample from a random song
-    # It's possible that some songs don't have samples to choose from
-    song = random.choice([k for k in samples.keys() if samples[k]])
-    return [random.choice(samples[song])]
+class AliasSampler():
+    """
+    Draws indices with the given (relative) weights
+    in constant time, with Vose's alias method.
+    """
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        probs = [w * n/total for w in weights]
+        self.probs = [1.] * n
+        self.aliases = list(range(n))
+
+        small = [i for i, p in enumerate(probs) if p < 1]
+        large = [i for i, p in enumerate(probs) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probs[s] = probs[s]
+            self.aliases[s] = l
+            probs[l] -= 1 - probs[s]
+            if probs[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+
+    def draw(self):
+        i = random.randrange(len(self.probs))
+        if random.random() < self.probs[i]:
+            return i
+        return self.aliases[i]
+
+
+class Arrangement():
+    """
+    Which song is playing in each track at each slot
+    (i.e. each stretch of the smallest sample size),
+    as a `(tracks, slots)` array of song indices (-1 where nothing is).
 
+    This makes it cheap to check which songs are free
+    to play in one track while the others are playing.
 
-def filter_slices(slices):
+    The songs with samples of each size, and the samples themselves,
+    are tabled up front and reused for every bar, as are the samplers
+    for moving between samples in coherent tracks (see `TRANSITIONS`).
+    """
+    def __init__(self, songs, length, n_tracks, transitions=None):
+        self.songs = songs
+        self.index = {s.name: i for i, s in enumerate(songs)}
+        self.min_size = min(s.min_size for s in songs)
+        self.occupancy = np.full((n_tracks, length//self.min_size), -1, dtype=int)
+
+        # For each size, the songs which have samples of that size,
+        # and the indices of those samples
+        self.candidates = defaultdict(list)
+        self.samples = {}
+        for i, song in enumerate(songs):
+            for size in song.sizes:
+                present = np.flatnonzero(song.tables[size] >= 0)
+                if len(present):
+                    self.candidates[size].append(i)
+                    self.samples[i, size] = present
+        self.candidates = {size: np.array(c) for size, c in self.candidates.items()}
+
+        transitions = transitions or TRANSITIONS
+        self.moves = ['repeat', 'next', 'random']
+        self.transitions = AliasSampler([transitions[m] for m in self.moves])
+
+        # For when the previous sample can't be repeated;
+        # if nothing else is possible, play a random sample
+        weights = [0] + [transitions[m] for m in self.moves[1:]]
+        self.transitions_ = AliasSampler(weights if sum(weights) else [0, 0, 1])
+
+
+    def build_bar(self, track, n, bar_position=0, prev_sample=None, coherent=True):
+        """
+        Builds a bar of `n` beats into a track, starting `bar_position` slots in
+        (see `heuristics.build_bar`), and returns it as a list of Samples.
+
+        Bars are built from left to right off a stack rather than by recursion,
+        so each sub-bar knows the sample which was placed just before it.
+        """
+        if track > len(self.songs):
+            raise Exception('Must have more songs available than overlaid tracks')
+
+        counts = self._counts(track)
+        bar = []
+        stack = [(n, bar_position)]
+        while stack:
+            n, position = stack.pop()
+            if n < self.min_size:
+                raise Exception('Can\'t create a bar shorter than the shortest sample')
+
+            # If this is the smallest sample size,
+            # we can only place full bars.
+            # Otherwise, slightly favor complete bars, if available
+            sample = None
+            if n == self.min_size or random.random() <= FULL_BAR:
+                if coherent:
+                    sample = self._select(counts, n, position, prev_sample)
+                else:
+                    sample = self._random(counts, n, position)
+
+                # ugh, well we can overlap songs, I _guess_...
+                if sample is None and n == self.min_size:
+                    sample = self._random(None, n, position)
+                    if sample is None:
+                        raise Exception('There are no samples of {0} beats'.format(n))
+
+            if sample is not None:
+                self._place(track, position, sample)
+                bar.append(sample)
+                prev_sample = sample
+
+            # Otherwise, assemble the bar from two sub-bars,
+            # (pushed in reverse so the first is built first)
+            else:
+                n_ = n//2
+                stack.append((n_, position + n_//self.min_size))
+                stack.append((n_, position))
+
+        return bar
+
+
+    def _select(self, counts, n, position, prev_sample):
+        """
+        Selects a sample of length `n` via a markov chain:
+        repeating the previous sample, playing the next one in its song,
+        or playing a random one (see `TRANSITIONS`).
+        The previous sample's song can only be continued if it's free.
+        """
+        if prev_sample is not None and (self.index[prev_sample.song.name], n) in self.samples \
+                and self._free(counts, self.index[prev_sample.song.name], n, position):
+            sampler = self.transitions if prev_sample.size == n else self.transitions_
+            move = self.moves[sampler.draw()]
+
+            if move == 'repeat':
+                return prev_sample
+
+            if move == 'next':
+                next_sample = prev_sample.song.next_sample(prev_sample, n)
+                if next_sample is not None:
+                    return next_sample
+
+        return self._random(counts, n, position)
+
+
+    def _random(self, counts, n, position):
+        """
+        Selects a random sample of length `n` from a random song which is free
+        over `n` beats from `position` (any song, if `counts` is None).
+        Returns None if there aren't any.
+        """
+        candidates = self.candidates.get(n)
+        if candidates is None:
+            return None
+
+        # Most songs are usually free, so try a few at random first
+        song = None
+        for _ in range(MAX_TRIES):
+            i = candidates[random.randrange(len(candidates))]
+            if counts is None or self._free(counts, i, n, position):
+                song = i
+                break
+
+        if song is None:
+            end = position + n//self.min_size
+            free = candidates[counts[candidates,end] == counts[candidates,position]]
+            if not len(free):
+                return None
+            song = free[random.randrange(len(free))]
+
+        samples = self.samples[song, n]
+        return Sample(self.songs[song], n, samples[random.randrange(len(samples))])
+
+
+    def _free(self, counts, song, n, position):
+        """
+        Whether a song isn't playing in any other track over `n` beats from `position`.
+        """
+        return counts[song, position + n//self.min_size] == counts[song, position]
+
+
+    def _counts(self, track):
+        """
+        Prefix sums of how many of the other tracks each song plays in,
+        i.e. `counts[song, i]` is the number of (track, slot) pairs
+        before slot `i` in which the song is playing.
+        """
+        n_songs, n_slots = len(self.songs), self.occupancy.shape[1]
+        playing = np.zeros((n_songs, n_slots), dtype=int)
+        for i, row in enumerate(self.occupancy):
+            if i == track:
+                continue
+            slots = np.flatnonzero(row >= 0)
+            np.add.at(playing, (row[slots], slots), 1)
+        counts = np.zeros((n_songs, n_slots + 1), dtype=int)
+        np.cumsum(playing, axis=1, out=counts[:,1:])
+        return counts
+
+
+    def _place(self, track, position, sample):
+        n_slots = sample.size//self.min_size
+        self.occupancy[track, position:position+n_slots] = self.index[sample.song.name]
+
+
+def filter_slices(slices, tolerance=JITTER):
     """
     Filters slices to those that are of the most popular duration.
 
     The beat slicing slices slices of varying duration; even very slight variations
     will lead to beat slippage. So we compare sample durations and select only the
-    duration with the most slices.
+    duration with the most slices (give or take `tolerance` seconds, so that
+    a sample or two of rounding doesn't split slices of the same duration apart).
 
     I tried including slices from within a range of +- 0.05s of this duration and
     then time stretching them, but time stretching (at least with sox)
@@ -188,20 +351,20 @@ def filter_slices(slices):
     This way the temporal adjacency structure of the slices is preserved,
     just with gaps.
     """
+    # This uses the slices' lengths, so no audio is decoded.
+    durs = np.array([s.duration for slics in slices.values() for s in slics])
+    if not len(durs):
+        return slices
 
-    # Group slices by sample size and duration
-    durs = defaultdict(list)
-    for song, slics in slices.items():
-        for s in slics:
-            dur = duration(s.file)
-            durs[dur].append(s)
-
-    # Identify the duration with the most slices
-    best = max(durs.keys(), key=lambda d: len(durs[d]))
+    # Identify the duration with the most slices within `tolerance` of it
+    sorted_durs = np.sort(durs)
+    counts = np.searchsorted(sorted_durs, sorted_durs + tolerance, side='right') - \
+        np.searchsorted(sorted_durs, sorted_durs - tolerance, side='left')
+    best = sorted_durs[np.argmax(counts)]
 
     # The non-qualifying slices become None (gaps)
     for song, slics in slices.items():
-        slices[song] = [s if s in durs[best] else None for s in slics]
+        slices[song] = [s if abs(s.duration - best) <= tolerance else None for s in slics]
 
     return slices
 
@@ -210,34 +373,13 @@ def assemble_samples(samples):
     """
     Generates samples of the next largest size (n*2).
 
-    Samples should be in the form:
-
-        [ <Sample>, ... ]
-
-    That is, each sample should be represented as a tuple of its constituent samples.
+    Samples should be a table (see `Song`) of the index
+    of each sample's first slice, with -1 for gaps.
 
     This iterates over samples as non-overlapping pairs,
-    adding a complete tuple if the pair consists of
-    two present samples or None otherwise.
+    adding a sample if the pair consists of
+    two present samples or a gap (-1) otherwise.
     """
-    # Assuming samples are of the same length
-    # and from the same song (they should be)
-    samp = next((s for s in samples if s is not None), None)
-
-    # If this is None, that means no slices
-    # successfully made it through filtering
-    if samp is None:
-        return [None for _ in samples]
-
-    n = samp.size * 2
-    song = samp.song
-
-    larger_samples = []
-    for i, (s1, s2) in enumerate(zip(samples[::2], samples[1::2])):
-        if s1 is None or s2 is None:
-            larger_samples.append(None)
-        else:
-            sample = Sample(s1.slices + s2.slices, song, n, i)
-            larger_samples.append(sample)
-
-    return larger_samples
+    n = len(samples)//2
+    firsts, seconds = samples[0:2*n:2], samples[1:2*n:2]
+    return np.where((firsts >= 0) & (seconds >= 0), firsts, -1).astype(samples.dtype)
@@ -0,0 +1,84 @@
+import numpy as np
+from collections import defaultdict
+from pablo import datastore
+from pablo.models.key import Key
+
+# Every key, i.e. each note in each scale
+KEYS = [Key(k, scale) for scale in ['major', 'minor'] for k in Key.maj_keys]
+KEY_INDEX = {(k.key, k.scale): i for i, k in enumerate(KEYS)}
+
+# Key compatibility between every pair of keys, so key checks
+# are lookups rather than Key comparisons:
+# - MIXABLE[i, j] is whether KEYS[i] is mixable with KEYS[j]
+# - DISTANCE[i, j] is the shortest semitone distance from KEYS[i] to KEYS[j]
+MIXABLE = np.array([[k.mixable(k_) for k_ in KEYS] for k in KEYS], dtype=bool)
+DISTANCE = np.array([[k.distance(k_) for k_ in KEYS] for k in KEYS], dtype=int)
+
+
+def compatible_keys(key, key_range=0):
+    """
+    Returns the keys which are mixable with the given key
+    or within `key_range` semitones of it.
+    """
+    i = KEY_INDEX[key.key, key.scale]
+    mask = MIXABLE[i] | (np.abs(DISTANCE[i]) <= key_range)
+    return [KEYS[j] for j in np.flatnonzero(mask)]
+
+
+class Library():
+    """
+    An index over a set of song files, for querying
+    their analyses without touching the audio.
+    """
+    def __init__(self, files, progress=None):
+        """
+        Every file is hashed (unless it was before), which takes a while
+        for a library that hasn't been seen before; `progress` (if given)
+        is called with each file once it's been hashed.
+        """
+        self.files = files
+        self.analyses = {}
+
+        # Different files may have the same contents
+        self.hashes = datastore.fingerprint_many(files, progress=progress)
+        self.paths = defaultdict(list)
+        for f, hash in zip(files, self.hashes):
+            self.paths[hash].append(f)
+
+
+    @property
+    def unanalyzed(self):
+        """
+        The files which haven't been analyzed yet.
+        """
+        analyzed = datastore.load_hashes(self.hashes)
+        return [f for f, hash in zip(self.files, self.hashes) if hash not in analyzed]
+
+
+    def analyze(self, file):
+        """
+        Analyzes a file (if necessary), remembering
+        its analysis for the life of this library.
+        """
+        from pablo import analysis
+
+        if file not in self.analyses:
+            self.analyses[file] = analysis.analyze(file)
+        return self.analyses[file]
+
+
+    def compatible(self, bpm, key, bpm_range=0.15, key_range=0):
+        """
+        Returns the analyzed songs which are within `bpm_range` (a fraction of `bpm`)
+        and have a key which is mixable with `key` or within `key_range` semitones of it.
+
+        Songs are returned as a list of `(file, bpm, key)`.
+        """
+        keys = [(k.key, k.scale) for k in compatible_keys(key, key_range)]
+        bpm_range = ((1 - bpm_range) * bpm, (1 + bpm_range) * bpm)
+
+        songs = []
+        for hash, bpm_, key_, scale in datastore.find(bpm_range, keys):
+            for f in self.paths.get(hash, []):
+                songs.append((f, bpm_, Key(key_, scale)))
+        return songs
@@ -1,20 +1,71 @@
 class Sample():
     """
     A sample for a song, composed of slices (parts).
+
+    Samples are lightweight views onto their song's sample tables
+    (see `Song`), so they're created as they're needed
+    and two views of the same sample are equal.
     """
-    def __init__(self, slices, song, size, index):
-        self.slices = slices
+    __slots__ = ('song', 'size', 'index')
+
+    def __init__(self, song, size, index):
         self.song = song
         self.size = size
         self.index = index
 
 
+    @property
+    def slices(self):
+        """
+        The slices which make up this sample, in order.
+        """
+        start = self.song.tables[self.size][self.index]
+        return tuple(self.song.slices[start:start + self.size//self.song.min_size])
+
+
+    def __eq__(self, other):
+        return isinstance(other, Sample) and \
+            (self.song, self.size, self.index) == (other.song, other.size, other.index)
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash((id(self.song), self.size, self.index))
+
+
 class Slice():
     """
     A sample of the smallest size, used to construct
     longer samples.
+
+    If the slice's length is known (e.g. from when it was cut),
+    its duration is exact and doesn't require reading the file.
+    Likewise its `peak` (absolute sample value), if it was recorded,
+    means it can be normalized without being decoded first.
     """
-    def __init__(self, file):
+    __slots__ = ('file', 'n_samples', 'sample_rate', 'peak', 'song', '_duration')
+
+    def __init__(self, file, n_samples=None, sample_rate=None, peak=None):
         self.file = file
+        self.n_samples = n_samples
+        self.sample_rate = sample_rate
+        self.peak = peak
+        self.song = None
+        self._duration = None
+
 
+    @property
+    def duration(self):
+        """
+        The duration of the slice in seconds.
+        """
+        if self.n_samples is not None:
+            return self.n_samples/float(self.sample_rate)
 
+        if self._duration is None:
+            from pablo.analysis import probe_duration
+            self._duration = probe_duration(self.file)
+        return self._duration
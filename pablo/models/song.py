@@ -1,3 +1,4 @@
+import numpy as np
 from pablo.models.sample import Sample
 from pablo.heuristics import assemble_samples
 
@@ -5,6 +6,10 @@ from pablo.heuristics import assemble_samples
 class Song():
     """
     A song and its constituent samples.
+
+    Samples aren't kept as objects; for each size there's a table
+    of the index of each sample's first slice, with -1 for gaps.
+    `song[size]` gives a sequence of `Sample` views over a table.
     """
     def __init__(self, name, slices, chunk_sizes):
         """
@@ -19,33 +24,72 @@ class Song():
             if slice is not None:
                 slice.song = self
 
-        # Assemble the samples, starting with the smallest
+        # Assemble the sample tables, starting with the smallest
         self.min_size = min(self.sizes)
-        self.samples = {
-            self.min_size: [Sample((s,), self, self.min_size, i) if s is not None else None
-                       for i, s in enumerate(self.slices)]
+        self.tables = {
+            self.min_size: np.array([i if s is not None else -1 for i, s in enumerate(self.slices)], dtype=np.int32)
         }
 
         # Create samples of larger chunk sizes.
         for size, size_ in zip(self.sizes, self.sizes[1:]):
-            self.samples[size_] = assemble_samples(self.samples[size])
+            self.tables[size_] = assemble_samples(self.tables[size])
 
 
     def __getitem__(self, size):
         """
         Samples for the given size
         """
-        return self.samples[size]
+        return Samples(self, size)
+
+
+    def sample(self, size, index):
+        """
+        The sample of a given size at an index,
+        or None if it is a gap.
+        """
+        if self.tables[size][index] < 0:
+            return None
+        return Sample(self, size, index)
 
 
     def next_sample(self, prev_sample, size):
         """
         Returns the next sample of a given size, after the
-        specified sample (which can be of any size).
+        specified sample (which can be of any size), i.e. the first one
+        which starts at or after the end of the specified sample.
         Returns None if it is a gap or the end of the song is reached.
         """
-        nidx = (prev_sample.size/size * prev_sample.index) + 1
-        if len(self[size]) <= nidx:
+        end = (prev_sample.index + 1) * prev_sample.size
+        nidx = -(-end//size)
+        if len(self.tables[size]) <= nidx:
             return None
         else:
-            return self[size][nidx]
+            return self.sample(size, nidx)
+
+
+class Samples():
+    """
+    The samples of one size for a song, with None for gaps.
+    """
+    __slots__ = ('song', 'size')
+
+    def __init__(self, song, size):
+        self.song = song
+        self.size = size
+
+
+    def __len__(self):
+        return len(self.song.tables[self.size])
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.song.sample(self.size, index)
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.song.sample(self.size, i)
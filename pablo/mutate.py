@@ -1,6 +1,8 @@
 import os
 import subprocess
-from essentia import standard
+import numpy as np
+from pablo import dsp
+from pablo.models.sample import Slice
 
 try:
     from subprocess import DEVNULL
@@ -8,16 +10,155 @@ except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 
 
+def process(infile, outfile, transforms, backend='sox'):
+    """
+    Applies a chain of transforms to a song in one pass,
+    i.e. the song is decoded once and encoded once,
+    with no intermediate files.
+
+    The `backend` is either `'sox'`, or `'numpy'` to process
+    the song in memory (see `pablo.dsp`). With the numpy backend,
+    tempo changes produce exactly the expected number of samples.
+
+    Transforms are applied in order, and are any of:
+
+        - `pitch(from_key, to_key)`
+        - `tempo(from_bpm, to_bpm)`
+        - `trim(duration, threshold)`
+        - `click(beats)`
+
+    Silence is trimmed and clicks are marked on the output,
+    i.e. after every other transform.
+
+    Returns how much was trimmed off the start of the output
+    (in seconds), so its beats can be worked out (see `transform_beats`).
+    """
+    if backend == 'numpy':
+        return _process(infile, outfile, transforms)
+    elif backend != 'sox':
+        raise ValueError('Unknown backend: {0}'.format(backend))
+
+    effects = []
+    silence = None
+    beats = None
+    for name, value in transforms:
+        if name == 'pitch':
+            effects += ['pitch', str(value * 100)]
+        elif name == 'tempo':
+            effects += ['tempo', '-m', str(value)]
+        elif name == 'trim':
+            silence = value
+        elif name == 'click':
+            beats = value
+        else:
+            raise ValueError('Unknown transform: {0}'.format(name))
+
+    if silence is None and beats is None:
+        subprocess.call(['sox', infile, outfile] + effects)
+        return 0.
+
+    # Silence is trimmed (and clicks are added) here rather than by sox,
+    # so exactly how much was trimmed is known, so pipe sox's output
+    # through here before encoding
+    if effects:
+        sample_rate = 44100
+        proc = subprocess.Popen(['sox', infile, '-t', 'f32', '-r', str(sample_rate), '-c', '2', '-'] + effects,
+                                stdout=subprocess.PIPE)
+        audio = np.frombuffer(proc.communicate()[0], dtype=np.float32).reshape(-1, 2)
+    else:
+        audio, sample_rate = load(infile)
+
+    return _finish(audio, sample_rate, outfile, silence, beats)
+
+
+def _process(infile, outfile, transforms):
+    """
+    Applies transforms to a song in memory.
+    """
+    audio, sample_rate = load(infile)
+    silence = None
+    beats = None
+    for name, value in transforms:
+        if name == 'pitch':
+            audio = dsp.shift(audio, value)
+        elif name == 'tempo':
+            audio = dsp.stretch(audio, length=int(round(len(audio)/value)))
+        elif name == 'trim':
+            silence = value
+        elif name == 'click':
+            beats = value
+        else:
+            raise ValueError('Unknown transform: {0}'.format(name))
+
+    return _finish(audio, sample_rate, outfile, silence, beats)
+
+
+def _finish(audio, sample_rate, outfile, silence=None, beats=None):
+    """
+    Trims `silence` (`(duration, threshold)`, see `trim`)
+    from processed audio, marks its `beats`, and encodes it.
+    Returns how much was trimmed (in seconds).
+    """
+    trimmed = 0
+    if silence is not None:
+        duration, threshold = silence
+        audio, trimmed = dsp.trim_silence(audio, sample_rate, duration=duration, threshold=threshold)
+    if beats is not None:
+        audio = _click(audio, sample_rate, beats)
+    write(audio, sample_rate, outfile)
+    return trimmed/float(sample_rate)
+
+
+def pitch(from_key, to_key):
+    """
+    Shift from one key to another.
+    """
+    return ('pitch', from_key.distance(to_key))
+
+
+def tempo(from_bpm, to_bpm):
+    """
+    Stretch from one tempo to another, without changing pitch.
+    """
+    return ('tempo', to_bpm/from_bpm)
+
+
+def trim(duration=0.1, threshold=0.01):
+    """
+    Remove silence from the beginning of a song, i.e. everything
+    before the first `duration` seconds above `threshold` (of full scale).
+    <http://digitalcardboard.com/blog/2009/08/25/the-sox-of-silence/>
+    """
+    return ('trim', (duration, threshold))
+
+
+def click(beats):
+    """
+    Mark beats (in seconds) with clicks.
+    """
+    return ('click', beats)
+
+
+def transform_beats(beats, transforms, trimmed=0.):
+    """
+    Works out where a song's beats (in seconds) end up after
+    it's been processed with `transforms`, rather than tracking them again.
+
+    Tempo changes scale the beats; trimming shifts them back by however
+    much was `trimmed` off the processed song (as `process` returns).
+    Beats which were trimmed off are dropped.
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    for name, value in transforms:
+        if name == 'tempo':
+            beats = beats/value
+
+    beats = beats - trimmed
+    return beats[beats >= 0]
+
+
 def tempo_stretch(infile, from_bpm, to_bpm, outfile):
-    ratio = to_bpm/from_bpm
-    subprocess.call([
-        'sox',
-        infile,
-        outfile,
-        'tempo',
-        '-m',
-        str(ratio)
-    ])
+    process(infile, outfile, [tempo(from_bpm, to_bpm)])
     return outfile
 
 
@@ -26,34 +167,138 @@ def time_stretch(infile, from_time, to_time, outfile):
 
 
 def key_shift(infile, from_key, to_key, outfile):
-    semitones = from_key.distance(to_key)
-    cents = semitones * 100
-    subprocess.call([
-        'sox',
-        infile,
-        outfile,
-        'pitch',
-        str(cents)
-    ])
+    process(infile, outfile, [pitch(from_key, to_key)])
     return outfile
 
 
-def beat_slice(infile, beats, chunk_size, outdir, prefix='', format='mp3'):
-    outfiles = []
+def beat_slice(infile, beats, chunk_size, outdir, prefix='', format='mp3', length=None,
+               stretch=False, jitter=0.01, tolerance=0.05):
+    """
+    Slices a song into chunks of `chunk_size` beats.
+
+    The song is decoded once and every chunk is cut from the
+    decoded audio, starting at the sample nearest to its first beat.
+
+    Every chunk is cut to the same number of samples, so that chunks
+    of the same number of beats come out exactly as long as each other.
+    That's `length` (in seconds), if it's given, otherwise the typical
+    distance from a chunk's first beat to its last. Chunks whose beats span
+    more than `jitter` seconds away from that are off the grid,
+    and are cut at their beats instead (so they can be filtered out).
+
+    With `stretch`, chunks within `tolerance` (a fraction) of that length
+    are stretched from their first beat to their last to exactly that
+    length instead, so that small errors in the beats don't leave
+    them off the grid either.
+
+    Chunks which can't be encoded are skipped.
+    Returns a list of `Slice`s, which know their exact lengths and peaks.
+    """
+    slices = []
     format = format.strip('.')
     chunks = [beats[i:i + chunk_size] for i in range(0, len(beats), chunk_size)]
     chunks = [(c[0], c[-1]) for c in chunks]
 
-    for i, (start, end) in enumerate(chunks):
+    audio, sample_rate = load(infile)
+    bounds = [(int(round(start * sample_rate)), int(round(end * sample_rate))) for start, end in chunks]
+    if length is not None:
+        length = int(round(length * sample_rate))
+    else:
+        spans = [end - start for start, end in bounds if end > start]
+        length = int(round(np.median(spans))) if spans else 0
+
+    for i, (start, end) in enumerate(bounds):
+        if end <= start:
+            continue
+
+        off = abs((end - start) - length)
+        if stretch and off <= tolerance * length:
+            chunk = dsp.stretch(audio[start:end], length=length)
+        elif not stretch and off <= jitter * sample_rate:
+            chunk = audio[start:start + length]
+        else:
+            chunk = audio[start:end]
+
         outfile = '{0}{1}.{2}'.format(prefix, i, format)
         outfile = os.path.join(outdir, outfile)
-        outfile = slice(infile, start, end, outfile)
+        try:
+            write(chunk, sample_rate, outfile)
+        except RuntimeError:
+            continue
+        peak = float(np.max(np.abs(chunk))) if len(chunk) else 0.
+        slices.append(Slice(outfile, n_samples=len(chunk), sample_rate=sample_rate, peak=peak))
+
+    return slices
+
+
+def load(infile, sample_rate=None):
+    """
+    Decodes an audio file into an array of stereo samples,
+    resampling it if a `sample_rate` is specified.
+    Returns the samples and the sample rate.
+    """
+    from essentia import standard
 
-        # Sometimes the file isn't saved?
-        if os.path.exists(outfile):
-            outfiles.append(outfile)
+    audio, sample_rate_, _, _, _, _ = standard.AudioLoader(filename=infile)()
+    sample_rate_ = int(sample_rate_)
+    if sample_rate is None or sample_rate == sample_rate_:
+        return audio, sample_rate_
 
-    return outfiles
+    resample = standard.Resample(inputSampleRate=sample_rate_, outputSampleRate=sample_rate)
+    audio = np.stack([resample(np.ascontiguousarray(audio[:,i])) for i in range(audio.shape[1])], axis=1)
+    return audio, sample_rate
+
+
+def write(audio, sample_rate, outfile):
+    """
+    Encodes an array of samples to an audio file,
+    in the format given by the file's extension.
+
+    The samples are piped straight to the encoder,
+    so no samples are added or dropped.
+    """
+    encoder = Encoder(sample_rate, audio.shape[1], outfile)
+    encoder.write(audio)
+    return encoder.close()
+
+
+class Encoder():
+    """
+    Encodes samples to an audio file as they're written,
+    so the audio never has to be held in memory all at once.
+    """
+    def __init__(self, sample_rate, n_channels, outfile):
+        self.outfile = outfile
+        self.proc = subprocess.Popen([
+            'ffmpeg',
+            '-y',
+            '-f', 'f32le',
+            '-ar', str(sample_rate),
+            '-ac', str(n_channels),
+            '-i', '-',
+            outfile
+        ], stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL)
+
+
+    def write(self, audio):
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+        except IOError:
+            # ffmpeg has quit, see `close`
+            pass
+
+
+    def close(self):
+        """
+        Finishes encoding. Raises a RuntimeError if ffmpeg failed.
+        """
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.wait() != 0:
+            raise RuntimeError('Could not encode {0}'.format(self.outfile))
+        return self.outfile
 
 
 def slice(infile, start, end, outfile):
@@ -73,17 +318,8 @@ def slice(infile, start, end, outfile):
 def trim_silence(infile, outfile):
     """
     Remove silence from the beginning of a song.
-    <http://digitalcardboard.com/blog/2009/08/25/the-sox-of-silence/>
     """
-    subprocess.call([
-        'sox',
-        infile,
-        outfile,
-        'silence',
-        '1',
-        '0.1',
-        '1%'
-    ])
+    process(infile, outfile, [trim()])
     return outfile
 
 
@@ -93,10 +329,15 @@ def add_click(infile, beats, outfile):
 
     This is used for debugging beat alignment.
     """
-    audio = standard.MonoLoader(filename=infile)()
-    marker = standard.AudioOnsetsMarker(onsets=beats, type='beep')
-    marked_audio = marker(audio)
-    standard.MonoWriter(filename=outfile)(marked_audio)
+    process(infile, outfile, [click(beats)])
+    return outfile
+
+
+def _click(audio, sample_rate, beats):
+    from essentia import standard
+
+    marker = standard.AudioOnsetsMarker(onsets=beats, type='beep', sampleRate=sample_rate)
+    return np.stack([marker(np.ascontiguousarray(audio[:,i])) for i in range(audio.shape[1])], axis=1)
 
 
 def vocal_eq(infile, outfile):
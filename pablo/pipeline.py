@@ -0,0 +1,382 @@
+"""
+The stages of making a mix.
+"""
+
+import os
+import math
+import random
+import shutil
+import multiprocessing
+import numpy as np
+from colorama import Fore
+from functools import partial
+from pablo import mutate, cache, heuristics, producer
+from pablo.models.song import Song
+
+
+def validate(min_sample_size, max_sample_size, n_tracks, n_songs, length):
+    """
+    Checks mix parameters.
+    Returns a description of what's wrong, or None if they're ok.
+    """
+    if max_sample_size < min_sample_size:
+        return 'The max sample size must be larger than the min sample size'
+
+    n_u = math.log(max_sample_size, 2)
+    if int(n_u) != n_u:
+        return 'The max sample size must be a power of 2'
+
+    n_l = math.log(min_sample_size, 2)
+    if int(n_l) != n_l:
+        return 'The min sample size must be a power of 2'
+
+    dur = math.log(length, 2)
+    if int(dur) != dur:
+        return 'The song length must be a power of 2'
+
+    if n_songs is not None and n_tracks > n_songs:
+        return 'There must be at least as many songs as there are tracks'
+
+
+def select_songs(lib, focal=None, n_tracks=2, n_songs=None, seed=None, log=None):
+    """
+    Selects a focal song (unless one is given) from a `Library`,
+    and other songs which are compatible with it.
+
+    Given the same `seed` (and library), the same songs are selected.
+
+    Returns the focal song and the other songs,
+    each in the form `(file, bpm, key)`.
+    """
+    log = log or _quiet
+    rand = random.Random(seed)
+    unanalyzed = sorted(lib.unanalyzed)
+
+    # Select a song to base the mix around,
+    # preferring ones which have already been analyzed
+    if focal is None:
+        skip = set(unanalyzed)
+        files = sorted(f for f in lib.files if f not in skip) or sorted(lib.files)
+        focal = rand.choice(files)
+    focal_bpm, focal_key = lib.analyze(focal)
+
+    log('\nFocal song: {0}', focal, color=Fore.YELLOW)
+    log('\tBPM: {0}', focal_bpm)
+    log('\tKey: {0} ({1})', focal_key.key, focal_key.scale)
+
+    # Search for songs that require relatively small modifications
+    # to match the focal song
+    bpm_range = 0.15
+    key_range = 6
+
+    # Select appropriate songs to mix,
+    # first from songs that have already been analyzed
+    n = n_songs if n_songs is not None else rand.randint(n_tracks+2, n_tracks+6)
+    log('\nSelecting {0} other songs', n)
+
+    selections = lib.compatible(focal_bpm, focal_key, bpm_range=bpm_range, key_range=key_range)
+    selections = sorted((s for s in selections if s[0] != focal), key=lambda s: s[0])
+    rand.shuffle(selections)
+    selections = selections[:n]
+    for song, bpm, key in selections:
+        log('Selected {0}', song, color=Fore.CYAN)
+
+    # If there aren't enough, analyze more songs
+    files = [f for f in unanalyzed if f != focal]
+    rand.shuffle(files)
+    while len(selections) < n and files:
+        song = files.pop()
+        log('Analyzing {0}', song, color=Fore.CYAN)
+        try:
+            bpm, key = lib.analyze(song)
+        except RuntimeError:
+            log('\t{0}', 'Skipping (could not be analyzed)')
+            continue
+        if (1 - bpm_range) * focal_bpm <= bpm <= (1 + bpm_range) * focal_bpm and (focal_key.mixable(key) or abs(focal_key.distance(key)) <= key_range):
+            log('\t{0}', 'OK')
+            selections.append((song, bpm, key))
+        else:
+            log('\tSkipping')
+
+    return (focal, focal_bpm, focal_key), selections
+
+
+def make_mix(focal, selections, outdir, sample_sizes, n_tracks=2, length=512,
+             sample_format='mp3', backend='sox', cache_size=0, jobs=None,
+             coherent=True, verify_beats=False, debug=False, seed=None,
+             plan_only=False, stream=False, log=None):
+    """
+    Makes a mix in `outdir` from a focal song and other songs,
+    as selected by `select_songs`.
+
+    The mix's plan (see `producer.plan_tracks`) is saved alongside it,
+    as `_plan.json`, along with the `seed` for arranging it and the songs
+    it was made from. Pass the same seed to `select_songs` as well
+    to select the same songs again.
+
+    With `plan_only`, the mix is only planned, not rendered
+    (see `render`), and the path to the plan is returned instead.
+    The songs are still processed and sliced, since the plan
+    is made out of their slices, but the slices are kept (as `_slices.json`)
+    so the mix can be planned again, with other seeds, without
+    processing them again (see `replan`).
+    With `stream`, the mix is rendered in constant memory.
+
+    Returns the path to the mix.
+    """
+    log = log or _quiet
+    focal, focal_bpm, focal_key = focal
+    sample_dir = os.path.join(outdir, 'samples')
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+
+    # Mutate songs as needed and generate samples
+    log('\n{0}', 'Processing songs', color=Fore.YELLOW)
+    slices = {}
+    results = process_songs(selections + [(focal, focal_bpm, focal_key)],
+                            focal_bpm,
+                            focal_key,
+                            outdir,
+                            sample_dir,
+                            jobs=jobs,
+                            sample_size=min(sample_sizes),
+                            sample_format=sample_format,
+                            backend=backend,
+                            cache_size=cache_size,
+                            verify_beats=verify_beats,
+                            debug=debug)
+    for name, slics, notes in results:
+        log('Processed {0}', name, color=Fore.CYAN)
+        for note in notes:
+            log('\t{0}', note)
+        slices[name] = slics
+
+    # Remove samples which have irregular duration
+    slices = heuristics.filter_slices(slices)
+
+    # Keep the slices, so the mix can be planned again
+    # without processing the songs again (see `replan`)
+    producer.save_slices(slices, sample_sizes, os.path.join(outdir, '_slices.json'))
+
+    log('\n{0}', 'Planning tracks', color=Fore.YELLOW)
+    plan = plan_mix(slices, sample_sizes, length=length, coherent=coherent, n_tracks=n_tracks, seed=seed)
+    plan['songs'] = [focal] + [song for song, _, _ in selections]
+    plan_file = producer.save_plan(plan, os.path.join(outdir, '_plan.json'))
+    if plan_only:
+        return plan_file
+
+    return render(plan, outdir, stream=stream, log=log)
+
+
+def plan_mix(slices, sample_sizes, length=512, coherent=True, n_tracks=2, seed=None):
+    """
+    Plans a mix (see `producer.plan_tracks`) from songs' slices,
+    as `{song: [<Slice>, ...]}`, seeding the arrangement
+    so that the plan can be made again.
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    # Build songs + samples out of the slices
+    # Some songs may return no slices, in which case, ignore that song.
+    # (Sorted so that mixes are reproducible from their seeds)
+    songs = [Song(nm, slices[nm], sample_sizes) for nm in sorted(slices) if any(s is not None for s in slices[nm])]
+
+    random.seed(seed)
+    plan = producer.plan_tracks(songs, length=length, coherent=coherent, n_tracks=n_tracks)
+    plan['seed'] = seed
+    return plan
+
+
+def replan(mix_dir, seed=None, length=512, coherent=True, n_tracks=2):
+    """
+    Plans a mix again from the slices of a mix made
+    (or planned) before in `mix_dir`, without processing any songs,
+    e.g. to try other seeds. The plan is saved as `_plan_<seed>.json`
+    in `mix_dir`, and can be rendered with `render`.
+
+    Returns the path to the plan.
+    """
+    slices, sample_sizes = producer.load_slices(os.path.join(mix_dir, '_slices.json'))
+    plan = plan_mix(slices, sample_sizes, length=length, coherent=coherent, n_tracks=n_tracks, seed=seed)
+    return producer.save_plan(plan, os.path.join(mix_dir, '_plan_{0}.json'.format(plan['seed'])))
+
+
+def render(plan, outdir, stream=False, log=None):
+    """
+    Renders a mix from its plan (see `producer.plan_tracks`):
+    its tracks, the mix of them, and its tracklist, in `outdir`.
+
+    With `stream`, the mix is rendered straight from the plan
+    (see `producer.stream_mix`) in constant memory,
+    and the tracks aren't saved separately.
+
+    Returns the path to the mix.
+    """
+    log = log or _quiet
+    mix_file = os.path.join(outdir, '_mix.mp3')
+
+    if stream:
+        log('\n{0}', 'Streaming mix', color=Fore.YELLOW)
+        producer.stream_mix(plan, mix_file)
+        tracklist = producer.tracklist(plan)
+
+    else:
+        # Assemble tracks
+        log('\n{0}', 'Assembling tracks', color=Fore.YELLOW)
+        bus = producer.MixBus()
+        tracks, tracklist = producer.render_tracks(plan, outdir, bus=bus)
+
+        # Mix down the tracks
+        log('{0}', 'Assembling mix', color=Fore.YELLOW)
+        producer.produce_mix(bus, mix_file)
+
+    # Write the tracklist
+    tracklisting = '\n\n---\n\n'.join(['\n'.join(['{0}\t{1}'.format(t, s) for t, s in tl]) for tl in tracklist])
+    trl_file = os.path.join(outdir, '_tracklist.txt')
+    with open(trl_file, 'w') as f:
+        f.write(tracklisting)
+
+    return mix_file
+
+
+def process_songs(songs, focal_bpm, focal_key, outdir, sample_dir, jobs=None, **kwargs):
+    """
+    Processes songs (see `process_song`) concurrently,
+    across `jobs` processes (by default, one per CPU).
+
+    Songs should be in the form:
+
+        [(file, bpm, key), ...]
+
+    Yields the results of `process_song` in the same order as the songs.
+    """
+    process = partial(_process_song, focal_bpm=focal_bpm, focal_key=focal_key,
+                      outdir=outdir, sample_dir=sample_dir, **kwargs)
+
+    jobs = min(jobs or multiprocessing.cpu_count(), len(songs))
+    if jobs <= 1:
+        for song in songs:
+            yield process(song)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(process, songs):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def process_song(song, bpm, key, focal_bpm, focal_key, outdir, sample_dir,
+                 sample_size=16, sample_format='mp3', backend='sox', cache_size=0,
+                 verify_beats=False, debug=False):
+    """
+    Prepares a song for a mix: it's shifted to the focal song's key
+    (if necessary), stretched to the focal song's bpm, trimmed,
+    and then sliced into samples of `sample_size` beats.
+
+    The processed song is saved to `outdir` and its samples
+    to a directory for the song in `sample_dir`.
+
+    The processed song's beats are derived from the original song's beats;
+    with `verify_beats`, they're tracked again instead (which is much slower)
+    and the drift between the two is noted.
+
+    Returns the song's name, its slices, and notes on what was done.
+    """
+    from pablo import analysis
+
+    filename = os.path.basename(song)
+    name, ext = os.path.splitext(filename)
+    notes = []
+
+    outfile = os.path.join(outdir, filename)
+    tmpfile = os.path.join(outdir, '{0}.tmp{1}'.format(name, ext))
+
+    # Process as necessary, in one pass
+    transforms = []
+    if not focal_key.mixable(key):
+        notes.append('Changing key')
+        transforms.append(mutate.pitch(key, focal_key))
+
+    if focal_bpm != bpm:
+        notes.append('Changing bpm')
+        transforms.append(mutate.tempo(bpm, focal_bpm))
+
+    notes.append('Trimming silence')
+    transforms.append(mutate.trim())
+
+    # Reuse the processed song from an earlier mix, if possible
+    cache_key = cache.key(song, transforms, backend, ext)
+    beats = cache.get(cache_key, outfile) if cache_size else None
+    if beats is not None:
+        notes.append('Using cached song')
+    else:
+        trimmed = mutate.process(song, outfile, transforms, backend=backend)
+
+        # Work out the processed song's beats from the original's
+        beats, confidence, _ = analysis.beat_grid(song)
+        beats = mutate.transform_beats(beats, transforms, trimmed)
+        notes.append('Beat confidence: {0:.2f}'.format(confidence))
+
+        # Optionally, check them against the beats tracked on the processed song
+        if verify_beats:
+            tracked = analysis.estimate_beats(outfile)
+            notes.append('Beat drift: {0:.3f}s'.format(beat_drift(beats, tracked)))
+            beats = tracked
+
+        if cache_size:
+            cache.put(cache_key, outfile, beats, max_size=cache_size * 1024**2)
+
+    # Slice according to beats
+    notes.append('Slicing')
+
+    # If debug is set, add click track to check beat alignment
+    if debug:
+        mutate.process(outfile, tmpfile, [mutate.click(beats)], backend=backend)
+        shutil.move(tmpfile, outfile)
+
+    song_sample_dir = os.path.join(sample_dir, name)
+    os.makedirs(song_sample_dir)
+
+    # Assemble samples of the smallest sample size
+    # They will be combined later into larger samples
+    prefix = '{0}_{1}_'.format(name, sample_size)
+    # Samples are all cut to the length they should have at the focal bpm
+    # (they span from their first to their last beat).
+    # With the numpy backend, they're stretched to it instead
+    sample_length = (sample_size - 1) * 60./focal_bpm
+    slices = mutate.beat_slice(outfile,
+                               beats,
+                               sample_size,
+                               song_sample_dir,
+                               prefix=prefix,
+                               format=sample_format,
+                               length=sample_length,
+                               stretch=backend == 'numpy')
+    return name, slices, notes
+
+
+def beat_drift(beats, tracked):
+    """
+    The median distance (in seconds) from each tracked beat
+    to the nearest of the given beats.
+    """
+    beats = np.sort(np.asarray(beats, dtype=np.float64))
+    tracked = np.asarray(tracked, dtype=np.float64)
+    if not len(beats) or not len(tracked):
+        return float('nan')
+    idx = np.searchsorted(beats, tracked)
+    left = beats[np.clip(idx - 1, 0, len(beats) - 1)]
+    right = beats[np.clip(idx, 0, len(beats) - 1)]
+    dist = np.minimum(np.abs(tracked - left), np.abs(tracked - right))
+    return float(np.median(dist))
+
+
+def _process_song(song, **kwargs):
+    return process_song(*song, **kwargs)
+
+
+def _quiet(*args, **kwargs):
+    pass
@@ -1,47 +1,501 @@
 import os
-from pablo import heuristics, analysis
-from pydub import AudioSegment
+import json
+import numpy as np
+from pablo import heuristics, mutate
+from pablo.models.sample import Slice
 
 
-def produce_tracks(songs, outdir, length=256, coherent=True, n_tracks=2):
+def produce_tracks(songs, outdir, length=256, coherent=True, n_tracks=2, bus=None):
     """
     Generate some tracks from the given Songs.
+
+    Each track is saved to `outdir` and, if a `MixBus` is given,
+    added to it, so only one track is held in memory at a time.
+
+    Returns the track files and their tracklists.
     """
-    tracks = []
-    tracklist = []
+    plan = plan_tracks(songs, length=length, coherent=coherent, n_tracks=n_tracks)
+    return render_tracks(plan, outdir, bus=bus)
 
-    for i, slices in enumerate(heuristics.build_tracks(songs, length, n_tracks, coherent=coherent)):
-        files = [slice.file for slice in slices]
-        sounds = [AudioSegment.from_file(f) for f in files]
 
+def plan_tracks(songs, length=256, coherent=True, n_tracks=2, crossfade=15, headroom=0.1, transitions=None):
+    """
+    Arranges tracks from the given Songs without rendering them.
+
+    Returns a plan, in the form:
+
+        {
+            'sample_rate': 44100,
+            'crossfade': 15,
+            'tracks': [
+                [{'song': ..., 'file': ..., 'offset': ..., 'n_samples': ..., 'gain': ...}, ...],
+                ...
+            ]
+        }
+
+    where each track is a list of its slices, with the offset and length
+    (in samples) at which each is placed and the gain to normalize it
+    (None if the slice's peak isn't known). See `render_tracks`.
+    """
+    tracks = heuristics.build_tracks(songs, length, n_tracks, coherent=coherent, transitions=transitions)
+    sample_rate = _sample_rate([s for track in tracks for s in track])
+    return {
+        'sample_rate': sample_rate,
+        'crossfade': crossfade,
+        'tracks': [plan_track(track, sample_rate, crossfade=crossfade, headroom=headroom) for track in tracks]
+    }
+
+
+def plan_track(slices, sample_rate, crossfade=15, headroom=0.1):
+    """
+    Places slices one after the other, each crossfaded
+    (over `crossfade` ms) with the last. See `plan_tracks`.
+    """
+    xf = int(round(crossfade/1000. * sample_rate))
+    lengths = [int(round(s.duration * sample_rate)) for s in slices]
+    offsets = [0]
+    for n in lengths[:-1]:
+        offsets.append(offsets[-1] + n - xf)
+
+    return [{
+        'song': s.song.name if s.song is not None else None,
+        'file': s.file,
+        'offset': offset,
+        'n_samples': n,
+        'gain': 10**(-headroom/20.)/s.peak if s.peak else None
+    } for s, offset, n in zip(slices, offsets, lengths)]
+
+
+def render_tracks(plan, outdir, bus=None):
+    """
+    Renders the tracks of a plan (see `plan_tracks`) to `outdir`
+    and, if a `MixBus` is given, adds them to it.
+
+    Returns the track files and their tracklists.
+    """
+    tracks = []
+    sample_rate = plan['sample_rate']
+
+    for i, track_plan in enumerate(plan['tracks']):
         # Create the track audio
-        track = sounds[0].normalize()
-        for sound in sounds[1:]:
-            # Remove crossfade to keep timing right? Not sure if necessary
-            track = track.append(sound.normalize(), crossfade=15)
+        track = render_track(track_plan, sample_rate, crossfade=plan['crossfade'])
 
         track_file = os.path.join(outdir, 'track_{0}.mp3'.format(i))
-        track.export(track_file, format='mp3')
-        tracks.append(track)
+        mutate.write(track, sample_rate, track_file)
+        tracks.append(track_file)
+        if bus is not None:
+            bus.add(track, sample_rate)
+
+    return tracks, tracklist(plan)
+
+
+def tracklist(plan):
+    """
+    The tracklist of each track of a plan, as `(time, slice file)` pairs.
+    """
+    sample_rate = float(plan['sample_rate'])
+    return [[(s['offset']/sample_rate, os.path.basename(s['file'])) for s in track]
+            for track in plan['tracks']]
 
-        # Tracklist info
-        time = 0
-        timeline = []
-        for f in files:
-            timeline.append((time, os.path.basename(f)))
-            time += analysis.duration(f)
-        tracklist.append(timeline)
 
-    return tracks, tracklist
+def produce_mix(bus, outfile):
+    """
+    Mix down the tracks added to a `MixBus`.
+    """
+    mutate.write(bus.master(), bus.sample_rate, outfile)
+
+
+def stream_mix(plan, outfile, block_size=2**16, ceiling=-1.):
+    """
+    Renders a plan (see `plan_tracks`) straight to a mix, without
+    rendering its tracks first; see `mix_blocks`. The mix is piped to
+    the encoder as it's rendered, so memory use doesn't depend on its length.
+    """
+    encoder = mutate.Encoder(plan['sample_rate'], 2, outfile)
+    try:
+        for block in mix_blocks(plan, block_size=block_size, ceiling=ceiling):
+            encoder.write(block)
+    finally:
+        encoder.close()
+    return outfile
 
 
-def produce_mix(tracks, outfile, format='mp3'):
+def mix_blocks(plan, block_size=2**16, ceiling=-1.):
     """
-    Mix a list of tracks together.
+    Renders a plan (see `plan_tracks`) as a mix, in time order,
+    `block_size` samples at a time.
+
+    Only the slices which are playing in the current block are decoded.
+    The tracks are summed and mastered as in `MixBus`,
+    with a `Limiter` which works on a block at a time.
+
+    Yields blocks of the mix.
     """
-    mix = tracks[0]
-    for track in tracks[1:]:
-        mix = mix.overlay(track)
+    sample_rate = plan['sample_rate']
+    xf = int(round(plan['crossfade']/1000. * sample_rate))
+    tracks = [_TrackStream(track, xf, sample_rate) for track in plan['tracks'] if track]
+    length = max(t.length for t in tracks)
+    scale = 1/np.sqrt(len(tracks))
+    limiter = Limiter(sample_rate, ceiling=ceiling)
 
-    # Save the mix
-    mix.export(outfile, format=format)
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        block = np.zeros((end - start, 2), dtype=np.float32)
+        for track in tracks:
+            track.render(block, start)
+        block *= scale
+
+        block = limiter.process(block)
+        if len(block):
+            yield block
+
+    block = limiter.flush()
+    if len(block):
+        yield block
+
+
+class _TrackStream():
+    """
+    Renders a track from its plan (see `render_track`) a block at a time,
+    holding only the slices which are playing.
+    """
+    def __init__(self, track_plan, xf, sample_rate):
+        self.plan = track_plan
+        self.xf = xf
+        self.sample_rate = sample_rate
+        self.length = track_plan[-1]['offset'] + track_plan[-1]['n_samples'] if track_plan else 0
+        self.next = 0
+        self.live = []
+
+
+    def render(self, block, start):
+        """
+        Adds this track's audio from `start` onwards into `block`.
+        """
+        end = start + len(block)
+
+        # Decode the slices which start playing in this block,
+        # and drop those which have finished
+        while self.next < len(self.plan) and self.plan[self.next]['offset'] < end:
+            self.live.append((self.plan[self.next]['offset'], self._load(self.next)))
+            self.next += 1
+        self.live = [(offset, audio) for offset, audio in self.live if offset + len(audio) > start]
+
+        for offset, audio in self.live:
+            lo, hi = max(offset, start), min(offset + len(audio), end)
+            if lo < hi:
+                block[lo-start:hi-start] += audio[lo-offset:hi-offset]
+
+
+    def _load(self, i):
+        """
+        Decodes a slice and applies its gain and crossfades,
+        so that the slices only have to be summed.
+        """
+        s = self.plan[i]
+        n = s['n_samples']
+        audio, _ = mutate.load(s['file'], sample_rate=self.sample_rate)
+        audio = audio * s['gain'] if s['gain'] is not None else normalize(audio)
+        audio = _fit(audio, n).astype(np.float32)
+
+        # Fade in over the previous slice
+        xf = min(self.xf, n) if i > 0 else 0
+        if xf:
+            audio[:xf] *= np.linspace(0, 1, xf, dtype=np.float32)[:,None]
+
+        # Fade out under the next slice
+        if i + 1 < len(self.plan):
+            next_ = self.plan[i + 1]
+            xf = min(self.xf, next_['n_samples'])
+            lo = next_['offset'] - s['offset']
+            hi = min(lo + xf, n)
+            if lo < hi:
+                audio[lo:hi] *= 1 - np.linspace(0, 1, xf, dtype=np.float32)[:hi-lo,None]
+
+                # (after which the next slice takes over)
+                audio = audio[:hi]
+
+        return audio
+
+
+def assemble(slices, crossfade=15):
+    """
+    Assembles slices, one after the other, into a track.
+    Each slice is normalized and crossfaded (over `crossfade` ms) with the last.
+
+    Returns the track's samples, its sample rate,
+    and the offset (in samples) of each slice in the track.
+    """
+    sample_rate = _sample_rate(slices)
+    track_plan = plan_track(slices, sample_rate, crossfade=crossfade)
+    track = render_track(track_plan, sample_rate, crossfade=crossfade)
+    return track, sample_rate, [s['offset'] for s in track_plan]
+
+
+def render_track(track_plan, sample_rate, crossfade=15):
+    """
+    Renders a track from its plan (see `plan_track`).
+
+    The track's length is known up front, and each slice is written
+    into its place in the track as it's decoded, so only one slice
+    is decoded at a time and the track is never copied.
+    A slice that decodes to a slightly different length than expected
+    (e.g. because of encoder padding) is trimmed or padded to it,
+    so slices always land where they should.
+    """
+    xf = int(round(crossfade/1000. * sample_rate))
+    last = track_plan[-1]
+    track = np.zeros((last['offset'] + last['n_samples'], 2), dtype=np.float32)
+
+    for i, s in enumerate(track_plan):
+        offset, n = s['offset'], s['n_samples']
+        audio, _ = mutate.load(s['file'], sample_rate=sample_rate)
+        audio = audio * s['gain'] if s['gain'] is not None else normalize(audio)
+        audio = _fit(audio, n)
+
+        # Crossfade with what's already there
+        # (i.e. the end of the previous slice)
+        xf_ = min(xf, n) if i > 0 else 0
+        if xf_:
+            fade_in = np.linspace(0, 1, xf_, dtype=np.float32)[:,None]
+            fade_out = 1 - fade_in
+            track[offset:offset+xf_] *= fade_out
+            track[offset:offset+xf_] += audio[:xf_] * fade_in
+        track[offset+xf_:offset+n] = audio[xf_:]
+
+    return track
+
+
+def save_plan(plan, outfile):
+    """
+    Saves a plan as JSON. Slice files are saved relative
+    to the plan, so the plan can be moved along with them.
+    """
+    plan_dir = os.path.dirname(os.path.abspath(outfile))
+    plan = dict(plan, tracks=[[dict(s, file=os.path.relpath(s['file'], plan_dir)) for s in track]
+                              for track in plan['tracks']])
+    with open(outfile, 'w') as f:
+        json.dump(plan, f, indent=2)
+    return outfile
+
+
+def save_slices(slices, sample_sizes, outfile):
+    """
+    Saves a mix's slices (as `{song: [<Slice>, ...]}`, with None for gaps)
+    and its sample sizes as JSON, so the mix can be planned again from them
+    (see `load_slices`). Like plans, slice files are saved relative to it.
+    """
+    slices_dir = os.path.dirname(os.path.abspath(outfile))
+    table = {}
+    for song, slics in slices.items():
+        table[song] = [{
+            'file': os.path.relpath(s.file, slices_dir),
+            'n_samples': s.n_samples,
+            'sample_rate': s.sample_rate,
+            'peak': s.peak
+        } if s is not None else None for s in slics]
+    with open(outfile, 'w') as f:
+        json.dump({'sample_sizes': sample_sizes, 'slices': table}, f)
+    return outfile
+
+
+def load_slices(infile):
+    """
+    Loads a mix's slices and sample sizes, see `save_slices`.
+    """
+    slices_dir = os.path.dirname(os.path.abspath(infile))
+    with open(infile, 'r') as f:
+        data = json.load(f)
+    slices = {}
+    for song, slics in data['slices'].items():
+        slices[song] = [Slice(os.path.join(slices_dir, s['file']), n_samples=s['n_samples'],
+                              sample_rate=s['sample_rate'], peak=s['peak'])
+                        if s is not None else None for s in slics]
+    return slices, data['sample_sizes']
+
+
+def load_plan(infile):
+    plan_dir = os.path.dirname(os.path.abspath(infile))
+    with open(infile, 'r') as f:
+        plan = json.load(f)
+    plan['tracks'] = [[dict(s, file=os.path.join(plan_dir, s['file'])) for s in track]
+                      for track in plan['tracks']]
+    return plan
+
+
+def _sample_rate(slices):
+    """
+    The highest sample rate of the slices, so nothing is downsampled.
+    """
+    if all(s.sample_rate for s in slices):
+        return max(s.sample_rate for s in slices)
+    return max(mutate.load(s.file)[1] for s in slices)
+
+
+def normalize(audio, headroom=0.1):
+    """
+    Scale audio so that its peak is `headroom` dB below full scale.
+    """
+    peak = np.max(np.abs(audio)) if len(audio) else 0
+    if not peak:
+        return audio
+    return audio * (10**(-headroom/20.) / peak)
+
+
+def _fit(audio, n):
+    """
+    Trim or zero-pad audio to n samples.
+    """
+    if len(audio) >= n:
+        return audio[:n]
+    return np.concatenate([audio, np.zeros((n - len(audio), audio.shape[1]), dtype=audio.dtype)])
+
+
+class MixBus():
+    """
+    Sums tracks into a single (float) accumulator.
+    """
+    def __init__(self):
+        self.audio = None
+        self.sample_rate = None
+        self.n_tracks = 0
+
+
+    def add(self, audio, sample_rate):
+        if self.audio is None:
+            self.audio = np.zeros(audio.shape, dtype=np.float32)
+            self.sample_rate = sample_rate
+        elif sample_rate != self.sample_rate:
+            raise ValueError('Tracks must have the same sample rate')
+
+        if len(audio) > len(self.audio):
+            self.audio = _fit(self.audio, len(audio))
+        self.audio[:len(audio)] += audio
+        self.n_tracks += 1
+
+
+    def master(self, ceiling=-1.):
+        """
+        Gain stages and limits the summed tracks,
+        so they don't clip no matter how many there are.
+        This is done in place, so the bus is left mastered.
+        """
+        # The tracks are each normalized, so scale them to sum
+        # to about the same loudness as one track
+        self.audio *= 1/np.sqrt(self.n_tracks)
+        return limit(self.audio, self.sample_rate, ceiling=ceiling)
+
+
+def limit(audio, sample_rate, ceiling=-1., lookahead=5.):
+    """
+    A lookahead peak limiter, applied in place. Gain is reduced
+    (over `lookahead` ms) ahead of any peaks that would go over
+    the ceiling (in dBFS), and recovers just as quickly after them.
+    """
+    size = max(1, int(sample_rate * lookahead/1000.))
+    gains = limiter_gains(np.max(np.abs(audio), axis=1), size, ceiling=ceiling)
+    apply_gains(audio, gains, size)
+    return audio
+
+
+class Limiter():
+    """
+    The same limiter as `limit`, but for audio which comes
+    a block at a time. Audio is held back until the peaks
+    after it (which its gain depends on) have come in,
+    i.e. for up to two lookaheads.
+    """
+    def __init__(self, sample_rate, ceiling=-1., lookahead=5.):
+        self.size = max(1, int(sample_rate * lookahead/1000.))
+        self.ceiling = ceiling
+        self.buffer = None
+
+        # The gain needed by the block before the buffer
+        self.prev = 1.
+
+
+    def process(self, audio):
+        """
+        Adds audio to the limiter and returns
+        as much limited audio as is ready.
+        """
+        self.buffer = audio if self.buffer is None else np.concatenate([self.buffer, audio])
+
+        # A block is ready once the two blocks after it have come in
+        n_blocks = len(self.buffer)//self.size
+        n_ready = n_blocks - 2
+        if n_ready < 1:
+            return self.buffer[:0]
+
+        raw = self._gains(self.buffer[:n_blocks * self.size])
+        gains = np.concatenate([[self.prev], raw])
+        gains = np.minimum(np.minimum(gains[:-2], gains[1:-1]), gains[2:])[:n_ready+1]
+        return self._apply(n_ready, gains, raw)
+
+
+    def flush(self):
+        """
+        Returns the rest of the limited audio.
+        """
+        if self.buffer is None or not len(self.buffer):
+            return np.zeros((0, 2), dtype=np.float32)
+
+        raw = self._gains(self.buffer)
+        gains = np.concatenate([[self.prev], raw, [1]])
+        gains = np.minimum(np.minimum(gains[:-2], gains[1:-1]), gains[2:])
+        gains = np.append(gains, gains[-1])
+        return self._apply(len(raw), gains, raw)
+
+
+    def _gains(self, audio):
+        return _block_gains(np.max(np.abs(audio), axis=1), self.size, self.ceiling)
+
+
+    def _apply(self, n_blocks, gains, raw):
+        """
+        Ramps the first `n_blocks` blocks of the buffer between
+        their `gains` (see `apply_gains`), and releases them.
+        """
+        n = min(n_blocks * self.size, len(self.buffer))
+        audio, self.buffer = self.buffer[:n], self.buffer[n:]
+        samples = np.arange(n)
+        g = np.interp(samples, np.arange(n_blocks + 1) * self.size, gains[:n_blocks + 1])
+        self.prev = raw[n_blocks - 1]
+        return audio * g.astype(audio.dtype)[:,None]
+
+
+def limiter_gains(peaks, size, ceiling=-1.):
+    """
+    Computes the gain for each block of `size` samples needed to keep
+    peaks under the ceiling. Each block takes the lowest gain of itself
+    and its neighbours, so that the gain between blocks can be ramped
+    (see `apply_gains`) without any peaks going over.
+    """
+    gains = np.concatenate([[1], _block_gains(peaks, size, ceiling), [1]])
+    return np.minimum(np.minimum(gains[:-2], gains[1:-1]), gains[2:])
+
+
+def _block_gains(peaks, size, ceiling):
+    """
+    The gain each block of `size` samples needs on its own
+    to keep its peak under the ceiling.
+    """
+    n_blocks = -(-len(peaks) // size)
+    blocks = np.zeros(n_blocks * size, dtype=peaks.dtype)
+    blocks[:len(peaks)] = peaks
+    blocks = blocks.reshape(n_blocks, size).max(axis=1)
+    return np.minimum(1, 10**(ceiling/20.)/np.maximum(blocks, 1e-12))
+
+
+def apply_gains(audio, gains, size, chunk_size=2**16):
+    """
+    Applies per-block gains to audio in place, ramping linearly from
+    each block's gain to the next. This is done in chunks (of blocks),
+    to keep the intermediate arrays small.
+    """
+    gains = np.append(gains, gains[-1])
+    for start in range(0, len(gains) - 1, chunk_size):
+        end = min(start + chunk_size, len(gains) - 1)
+        samples = np.arange(start * size, min(end * size, len(audio)))
+        g = np.interp(samples, np.arange(start, end + 1) * size, gains[start:end + 1])
+        audio[samples[0]:samples[-1] + 1] *= g.astype(audio.dtype)[:,None]
@@ -1,43 +1,132 @@
-import config
-from spotipy import Spotify, util
-try:
-    # python 3 only
-    import stagger
-    def get_artist_and_title(path):
-        try:
-            tags = stagger.read_tag(path)
-        except stagger.NoTagError:
-            return None, None
-        return tags.artist, tags.title
-except:
-    import eyed3
-    def get_artist_and_title(path):
+"""
+Looks up songs' audio features from the Spotify API.
+
+Lookups are cached in the datastore by file hash (including songs which
+couldn't be found), so each song is only ever looked up once.
+"""
+
+import time
+import requests
+import threading
+from multiprocessing.pool import ThreadPool
+from pablo import datastore
+
+API_BASE = 'https://api.spotify.com/v1'
+
+TRACKS_CHUNK_SIZE = 50 # spotify API maximum
+
+# How many searches to run at once
+JOBS = 8
+
+# How many times to retry a request which was rate limited
+# (or failed on Spotify's end), and how long to wait
+# before the first retry if Spotify doesn't say
+MAX_RETRIES = 5
+BACKOFF = 1.
+
+
+def get_artist_and_title(path):
+    """
+    Reads a song's artist and title from its tags.
+    """
+    try:
+        # python 3 only
+        import stagger
+    except ImportError:
+        import eyed3
         song = eyed3.load(path)
+        if song is None or song.tag is None:
+            return None, None
         return song.tag.artist, song.tag.title
 
-TRACKS_CHUNK_SIZE = 50 # spotify API maximum
+    try:
+        tags = stagger.read_tag(path)
+    except stagger.NoTagError:
+        return None, None
+    return tags.artist, tags.title
+
+
+class Client():
+    """
+    A minimal Spotify API client. Connections are pooled
+    (one per job) and rate limited requests are retried.
+
+    If no `token` is given, one is requested (via `config.py`, see the README)
+    the first time it's needed, rather than on import.
+    """
+    def __init__(self, token=None, api_base=API_BASE, jobs=JOBS):
+        self._token = token
+        self._token_lock = threading.Lock()
+        self.api_base = api_base.rstrip('/')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
 
-token = util.prompt_for_user_token(config.USERNAME,
-                                   client_id=config.CLIENT_ID,
-                                   client_secret=config.CLIENT_SECRET,
-                                   redirect_uri=config.REDIRECT_URI)
-spotify = Spotify(auth=token)
+    @property
+    def token(self):
+        # Requesting a token may prompt the user,
+        # so only one thread requests it
+        with self._token_lock:
+            if self._token is None:
+                import config
+                from spotipy import util
+                self._token = util.prompt_for_user_token(config.USERNAME,
+                                                         client_id=config.CLIENT_ID,
+                                                         client_secret=config.CLIENT_SECRET,
+                                                         redirect_uri=config.REDIRECT_URI)
+        return self._token
 
 
-def get_spotify_track(path):
+    def get(self, path, params=None):
+        """
+        Makes a request to the API, backing off and retrying
+        if it's rate limited. Returns the response's JSON.
+        """
+        url = '{0}/{1}'.format(self.api_base, path.lstrip('/'))
+        headers = {'Authorization': 'Bearer {0}'.format(self.token)}
+        for retry in range(MAX_RETRIES + 1):
+            resp = self.session.get(url, params=params, headers=headers)
+            if resp.status_code != 429 and resp.status_code < 500:
+                break
+            if retry < MAX_RETRIES:
+                wait = resp.headers.get('Retry-After')
+                time.sleep(float(wait) if wait is not None else BACKOFF * 2**retry)
+        resp.raise_for_status()
+        return resp.json()
+
+
+    def search_track(self, artist, title):
+        """
+        Returns the top matching track, or None if there isn't one.
+        """
+        query = 'artist:{0} track:{1}'.format(artist, title)
+        resp = self.get('search', params={'q': query, 'type': 'track'})
+        tracks = resp['tracks']['items']
+        return tracks[0] if tracks else None
+
+
+    def audio_features(self, ids):
+        """
+        Returns the audio features for tracks, in the same order.
+        """
+        features = []
+        for i in range(0, len(ids), TRACKS_CHUNK_SIZE):
+            resp = self.get('audio-features', params={'ids': ','.join(ids[i:i+TRACKS_CHUNK_SIZE])})
+            features += resp['audio_features']
+        return features
+
+
+def get_spotify_track(path, client=None):
+    client = client or Client()
     artist, title = get_artist_and_title(path)
     if not artist or not title:
         return None
-    query = 'artist:{} track:{}'.format(artist, title)
-    resp = spotify.search(q=query, type='track')
-    tracks = resp['tracks']['items']
-    if len(tracks) == 0:
-        return None
-    else:
-        return tracks[0]
+    return client.search_track(artist, title)
 
 
-def get_audio_features(paths):
+def get_audio_features(paths, client=None, jobs=JOBS):
     """
     gets audio features from the spotify API.
     refer to: <https://developer.spotify.com/web-api/get-several-audio-features/>
@@ -54,14 +143,74 @@ def get_audio_features(paths):
         - tempo
         - time_signature
         - valence
+
+    Songs which haven't been looked up before are searched
+    for concurrently, across `jobs` threads, and saved as they're found.
+
+    Returns, for each path, `{'features': ..., 'meta': <track>}`,
+    or None if the song couldn't be found. Songs which couldn't be
+    looked up (e.g. because of a network error) are also None,
+    but aren't cached, so they're looked up again next time.
     """
-    tracks = [get_spotify_track(path) for path in paths]
-    uris = [t['uri'] if t else None for t in tracks]
-    valid_uris = [uri for uri in uris if uri is not None]
-    results = {}
-    for i in range(0, len(valid_uris), TRACKS_CHUNK_SIZE):
-        for result in spotify.audio_features(tracks=valid_uris[i:i+TRACKS_CHUNK_SIZE]):
-            results[result['uri']] = result
-    return [{
-        'features': results[track['uri']],
-        'meta': track} if track else None for track in tracks]
\ No newline at end of file
+    hashes = datastore.fingerprint_many(paths)
+    cached = datastore.load_features(hashes)
+
+    # Look up the songs which aren't cached
+    todo = {}
+    for path, hash in zip(paths, hashes):
+        if hash not in cached and hash not in todo:
+            todo[hash] = path
+
+    if todo:
+        client = client or Client(jobs=jobs)
+
+        # Get a token before searching, rather than in every thread at once
+        client.token
+
+        def search(item):
+            hash, path = item
+            try:
+                return hash, get_spotify_track(path, client=client), True
+            except requests.RequestException:
+                return hash, None, False
+
+        found = []
+        pool = ThreadPool(min(jobs, len(todo)))
+        try:
+            for hash, track, ok in pool.imap_unordered(search, todo.items()):
+                if ok:
+                    found.append((hash, track))
+                if len(found) >= TRACKS_CHUNK_SIZE:
+                    _save_lookups(found, client, cached)
+                    found = []
+        finally:
+            pool.terminate()
+        _save_lookups(found, client, cached)
+
+    results = []
+    for hash in hashes:
+        track, features = cached.get(hash, (None, None))
+        results.append({'features': features, 'meta': track} if track else None)
+    return results
+
+
+def _save_lookups(found, client, cached):
+    """
+    Gets the features for found tracks, `[(hash, track), ...]`,
+    and saves them (in the datastore and `cached`).
+    """
+    ids = [t['id'] for _, t in found if t is not None]
+    try:
+        features = dict(zip(ids, client.audio_features(ids))) if ids else {}
+    except requests.RequestException:
+        # Leave the tracks to be looked up again
+        found = [(hash, track) for hash, track in found if track is None]
+        features = {}
+
+    rows = []
+    for hash, track in found:
+        feats = features.get(track['id']) if track is not None else None
+        cached[hash] = (track, feats)
+        rows.append((hash, track, feats))
+    if rows:
+        datastore.save_features(rows)
@@ -1,8 +1,27 @@
-from pablo import heuristics
+from pablo import heuristics, datastore, library, producer, mutate, dsp, cache, spotify, diglet, pipeline
 from pablo.models.key import Key
 from pablo.models.song import Song
 from pablo.models.sample import Slice
+import os
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
 import unittest
+import numpy as np
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
 
 class KeyTests(unittest.TestCase):
     def setUp(self):
@@ -55,13 +74,31 @@ class KeyTests(unittest.TestCase):
 
 
 class HeuristicsTests(unittest.TestCase):
-    #def test_assemble_samples(self):
-        #samples = [('a',), ('b',), None, ('c',), ('d',), ('e',)]
-        #samples_ = heuristics.assemble_samples(samples)
-        #self.assertEqual(samples_, [('a','b'), None, ('d', 'e')])
+    def test_assemble_samples(self):
+        samples = np.array([0, 1, -1, 3, 4, 5])
+        samples_ = heuristics.assemble_samples(samples)
+        self.assertEqual(list(samples_), [0, -1, 4])
+
+        samples_ = heuristics.assemble_samples(samples_)
+        self.assertEqual(list(samples_), [-1])
+
+
+    def test_song_samples(self):
+        slices = [Slice('a'), Slice('b'), None, Slice('c'), Slice('d'), Slice('e')]
+        song = Song('song', slices, [16, 32])
+        self.assertEqual([s and [s_.file for s_ in s.slices] for s in song[32]],
+                         [['a', 'b'], None, ['d', 'e']])
 
-        #samples_ = heuristics.assemble_samples(samples_)
-        #self.assertEqual(samples_, [None])
+        # Samples are views, so they're equal if they're the same sample
+        self.assertEqual(song[32][2], song.sample(32, 2))
+        self.assertEqual(song.next_sample(song[16][1], 16), None)
+        self.assertEqual(song.next_sample(song[16][0], 16), song[16][1])
+        self.assertEqual(song.next_sample(song[32][0], 16), song[16][2])
+        self.assertEqual(song.next_sample(song[16][3], 16), song[16][4])
+        self.assertEqual(song.next_sample(song[16][0], 32), None)
+        self.assertEqual(song.next_sample(song[16][1], 32), None)
+        self.assertEqual(song.next_sample(song[16][3], 32), song[32][2])
+        self.assertEqual(song.next_sample(song[32][2], 16), None)
 
 
     def test_build_bar(self):
@@ -80,7 +117,905 @@ class HeuristicsTests(unittest.TestCase):
             self.assertEqual(len(track), expected_n_slices)
 
 
+    def test_build_tracks(self):
+        names = ['Summer Crane', 'Frontier Psychiatrist', 'Electricity']
+        for coherent in [True, False]:
+            songs = [self._song_factory(name, sizes=[16, 32]) for name in names]
+            tracks = heuristics.build_tracks(songs, 256, 2, coherent=coherent)
+            self.assertEqual([len(t) for t in tracks], [16, 16])
+
+            # Songs never play in both tracks at once
+            for s1, s2 in zip(*tracks):
+                self.assertNotEqual(s1.song, s2.song)
+
+
+    def test_transitions(self):
+        songs = [self._song_factory(name, sizes=[16]) for name in ['a', 'b']]
+
+        # Always repeating plays the first sample throughout
+        track, = heuristics.build_tracks(songs, 128, 1, transitions={'repeat': 1, 'next': 0, 'random': 0})
+        self.assertEqual(len(set(track)), 1)
+
+        # Always moving on plays the song in order (from wherever it started)
+        track, = heuristics.build_tracks(songs, 128, 1, transitions={'repeat': 0, 'next': 1, 'random': 0})
+        slices = track[0].song.slices
+        expected = slices[slices.index(track[0]):][:len(track)]
+        self.assertEqual(track[:len(expected)], expected)
+
+
+    def test_alias_sampler(self):
+        weights = [0.3, 0.525, 0.175, 0]
+        sampler = heuristics.AliasSampler(weights)
+        draws = np.bincount([sampler.draw() for _ in range(20000)], minlength=4)/20000.
+        self.assertTrue(np.allclose(draws, weights, atol=0.02))
+
+
+    def test_filter_slices(self):
+        slices = {
+            'a': [Slice('a_0', 1000, 44100), Slice('a_1', 1000, 44100), Slice('a_2', 1010, 44100)],
+            'b': [Slice('b_0', 1001, 48000), Slice('b_1', 1000, 44100)],
+
+            # Off by a sample, from rounding
+            'c': [Slice('c_0', 1001, 44100), Slice('c_1', 999, 44100)]
+        }
+        slices = heuristics.filter_slices(slices)
+        self.assertEqual([s and s.file for s in slices['a']], ['a_0', 'a_1', None])
+        self.assertEqual([s and s.file for s in slices['b']], [None, 'b_1'])
+        self.assertEqual([s and s.file for s in slices['c']], ['c_0', 'c_1'])
+
+
     def _song_factory(self, name, sizes=[16, 32]):
         slices = [Slice('slice_{0}'.format(i)) for i in range(10)]
         song = Song(name, slices, sizes)
         return song
+
+
+class DatastoreTestCase(unittest.TestCase):
+    """
+    Runs tests against a temporary datastore.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = datastore.db_file
+        datastore.db_file = os.path.join(self.dir, 'songs.db')
+        self.files = []
+        for i in range(3):
+            path = os.path.join(self.dir, 'song_{0}.mp3'.format(i))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(1024))
+            self.files.append(path)
+
+
+    def tearDown(self):
+        datastore.close()
+        datastore.db_file = self.db_file
+        shutil.rmtree(self.dir)
+
+
+class DatastoreTests(DatastoreTestCase):
+    def test_save_load_many(self):
+        datastore.save_many([(self.files[0], 120., Key('C', 'major')),
+                             (self.files[1], 90., Key('A', 'minor'))])
+        self.assertEqual(datastore.load_many(self.files), [
+            (120., 'C', 'major'),
+            (90., 'A', 'minor'),
+            None
+        ])
+
+        # Re-saving replaces instead of duplicating
+        datastore.save(self.files[0], 121., Key('C', 'major'))
+        self.assertEqual(datastore.load(self.files[0]), (121., 'C', 'major'))
+        n = datastore.connect().execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+        self.assertEqual(n, 2)
+
+
+    def test_save_load_beats(self):
+        datastore.save(self.files[0], 120., Key('C', 'major'))
+        self.assertEqual(datastore.load_beats(self.files[0]), None)
+
+        datastore.save(self.files[0], 120., Key('C', 'major'), [0.5, 1., 1.5], 3.5, 2.)
+        self.assertEqual(datastore.load_beats(self.files[0]), ([0.5, 1., 1.5], 3.5, 2.))
+        self.assertEqual(datastore.load(self.files[0]), (120., 'C', 'major'))
+
+
+    def test_fingerprint(self):
+        hash = datastore.fingerprint(self.files[0])
+        self.assertEqual(hash, datastore._hash(self.files[0]))
+
+        # Changing the file changes its fingerprint
+        with open(self.files[0], 'ab') as f:
+            f.write(b'more')
+        self.assertNotEqual(datastore.fingerprint(self.files[0]), hash)
+
+
+    def test_fingerprint_progress(self):
+        done = []
+        hashes = datastore.fingerprint_many(self.files, progress=done.append)
+        self.assertEqual(done, [os.path.abspath(f) for f in self.files])
+        self.assertEqual(hashes, [datastore._hash(f) for f in self.files])
+
+
+    def test_migrate(self):
+        conn = sqlite3.connect(datastore.db_file)
+        conn.execute('CREATE TABLE songs (hash text, bpm real, key text, scale text)')
+        conn.execute('INSERT INTO songs VALUES ("a", 100, "C", "major")')
+        conn.execute('INSERT INTO songs VALUES ("a", 101, "C", "major")')
+        conn.execute('INSERT INTO songs VALUES ("b", 90, "A", "minor")')
+        conn.commit()
+        conn.close()
+
+        rows = datastore.connect().execute('SELECT hash, bpm FROM songs ORDER BY hash').fetchall()
+        self.assertEqual(rows, [('a', 101), ('b', 90)])
+
+
+class LibraryTests(DatastoreTestCase):
+    def test_key_tables(self):
+        for i, key in enumerate(library.KEYS):
+            for j, key_ in enumerate(library.KEYS):
+                self.assertEqual(library.MIXABLE[i, j], key.mixable(key_))
+                self.assertEqual(library.DISTANCE[i, j], key.distance(key_))
+
+
+    def test_compatible(self):
+        datastore.save_many([(self.files[0], 120., Key('C', 'major')),
+                             (self.files[1], 125., Key('B', 'minor')),
+                             (self.files[2], 150., Key('G', 'major'))])
+        lib = library.Library(self.files)
+        self.assertEqual(lib.unanalyzed, [])
+
+        # Every file's hashed up front, with progress
+        done = []
+        library.Library(self.files, progress=done.append)
+        self.assertEqual(len(done), len(self.files))
+
+        songs = lib.compatible(118., Key('C', 'major'))
+        self.assertEqual([s[0] for s in songs], [self.files[0]])
+
+        songs = lib.compatible(118., Key('C', 'major'), key_range=2)
+        self.assertEqual(sorted(s[0] for s in songs), self.files[:2])
+
+        songs = lib.compatible(118., Key('C', 'major'), bpm_range=0.3, key_range=2)
+        self.assertEqual(sorted(s[0] for s in songs), self.files)
+
+
+class CacheTests(DatastoreTestCase):
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        self.cache_dir = cache.cache_dir
+        cache.cache_dir = os.path.join(self.dir, 'cache')
+
+
+    def tearDown(self):
+        cache.cache_dir = self.cache_dir
+        super(CacheTests, self).tearDown()
+
+
+    def test_get_put(self):
+        transforms = [('tempo', 1.05), ('trim', (0.1, 0.01))]
+        key = cache.key(self.files[0], transforms, 'sox', '.mp3')
+        self.assertNotEqual(key, cache.key(self.files[0], transforms[1:], 'sox', '.mp3'))
+        self.assertNotEqual(key, cache.key(self.files[1], transforms, 'sox', '.mp3'))
+
+        outfile = os.path.join(self.dir, 'out.mp3')
+        self.assertIsNone(cache.get(key, outfile))
+
+        cache.put(key, self.files[0], [0.5, 1.0])
+        self.assertEqual(cache.get(key, outfile), [0.5, 1.0])
+        with open(outfile, 'rb') as f, open(self.files[0], 'rb') as f_:
+            self.assertEqual(f.read(), f_.read())
+
+
+    def test_evict(self):
+        outfile = os.path.join(self.dir, 'out.mp3')
+        for i, f in enumerate(self.files):
+            cache.put(str(i), f, [])
+
+        # Use the first song, so the second is the least recently used
+        cache.get('0', outfile)
+        cache.evict(2048)
+        self.assertIsNone(cache.get('1', outfile))
+        self.assertEqual(cache.get('0', outfile), [])
+        self.assertEqual(cache.get('2', outfile), [])
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 2)
+
+
+class ProducerTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_assemble(self):
+        lengths = [4410, 4410, 2205]
+        slices = [self._slice_factory(i, n, 0.25 * (i + 1)) for i, n in enumerate(lengths)]
+
+        track, sample_rate, offsets = producer.assemble(slices, crossfade=10)
+        self.assertEqual(sample_rate, 44100)
+        self.assertEqual(offsets, [0, 3969, 7938])
+        self.assertEqual(len(track), sum(lengths) - 2 * 441)
+
+        # Each slice is normalized
+        peak = 10**(-0.1/20)
+        self.assertAlmostEqual(track[1000, 0], peak, places=3)
+        self.assertAlmostEqual(track[6000, 1], peak, places=3)
+
+        # And crossfaded
+        self.assertTrue(np.all(np.abs(track[3969:4410]) <= peak + 1e-3))
+
+
+    def test_plan(self):
+        songs = []
+        for name in ['a', 'b', 'c']:
+            slices = [self._slice_factory('{0}_{1}'.format(name, i), 4410, 0.5) for i in range(4)]
+            for slice in slices:
+                slice.peak = 0.5
+            songs.append(Song(name, slices, [4, 8]))
+
+        # Plans are reproducible from the same seed
+        random.seed(1)
+        plan = producer.plan_tracks(songs, length=32, n_tracks=2)
+        random.seed(1)
+        self.assertEqual(producer.plan_tracks(songs, length=32, n_tracks=2), plan)
+
+        self.assertEqual([len(t) for t in plan['tracks']], [8, 8])
+        self.assertAlmostEqual(plan['tracks'][0][0]['gain'], 10**(-0.1/20)/0.5)
+
+        # And survive being saved and loaded
+        plan_file = producer.save_plan(plan, os.path.join(self.dir, 'plan.json'))
+        self.assertEqual(producer.load_plan(plan_file), plan)
+
+        track = producer.render_track(plan['tracks'][0], 44100)
+        self.assertEqual(len(track), plan['tracks'][0][-1]['offset'] + 4410)
+
+
+    def test_replan(self):
+        slices = {}
+        for name in ['a', 'b', 'c']:
+            slices[name] = [self._slice_factory('{0}_{1}'.format(name, i), 4410, 0.5) for i in range(4)] + [None]
+            for slice in slices[name][:-1]:
+                slice.peak = 0.5
+        plan = pipeline.plan_mix(slices, [4, 8], length=32, seed=1)
+
+        # The slices survive being saved and loaded
+        producer.save_slices(slices, [4, 8], os.path.join(self.dir, '_slices.json'))
+        slices_, sample_sizes = producer.load_slices(os.path.join(self.dir, '_slices.json'))
+        self.assertEqual(sample_sizes, [4, 8])
+        self.assertEqual([s and (s.file, s.n_samples, s.sample_rate, s.peak) for s in slices_['a']],
+                         [s and (s.file, s.n_samples, s.sample_rate, s.peak) for s in slices['a']])
+
+        # So the same plan can be made again from them
+        plan_file = pipeline.replan(self.dir, seed=1, length=32)
+        self.assertEqual(plan_file, os.path.join(self.dir, '_plan_1.json'))
+        self.assertEqual(producer.load_plan(plan_file), plan)
+
+
+    def test_limit(self):
+        audio = (np.random.randn(10001, 2) * 0.7).astype(np.float32)
+        quiet = np.full((1000, 2), 0.1, dtype=np.float32)
+        audio = np.concatenate([quiet, audio, quiet])
+
+        producer.limit(audio, 44100, ceiling=-1.)
+        self.assertTrue(np.abs(audio).max() <= 10**(-1/20.) + 1e-6)
+
+        # Quiet parts (away from peaks) are left alone
+        self.assertTrue(np.allclose(audio[:400], 0.1))
+        self.assertTrue(np.allclose(audio[-400:], 0.1))
+
+
+    def test_streaming_limiter(self):
+        audio = (np.random.randn(20001, 2) * 0.7).astype(np.float32)
+        expected = producer.limit(audio.copy(), 44100)
+
+        limiter = producer.Limiter(44100)
+        blocks = [limiter.process(audio[i:i+3000]) for i in range(0, len(audio), 3000)]
+        limited = np.concatenate(blocks + [limiter.flush()])
+        self.assertTrue(np.allclose(limited, expected))
+
+
+    def test_mix_blocks(self):
+        tracks = [[self._slice_factory('{0}_{1}'.format(t, i), 4410, 0.2 * (i + 1)) for i in range(3)]
+                  for t in range(2)]
+        sample_rate = 44100
+        plan = {
+            'sample_rate': sample_rate,
+            'crossfade': 15,
+            'tracks': [producer.plan_track(track, sample_rate) for track in tracks]
+        }
+
+        # Streaming gives the same mix as mixing whole tracks
+        bus = producer.MixBus()
+        for track in plan['tracks']:
+            bus.add(producer.render_track(track, sample_rate), sample_rate)
+        expected = bus.master()
+
+        mix = np.concatenate(list(producer.mix_blocks(plan, block_size=1000)))
+        self.assertTrue(np.allclose(mix, expected, atol=1e-6))
+
+
+    def test_mix_bus(self):
+        bus = producer.MixBus()
+        for n in [1000, 2000, 1500]:
+            bus.add(np.full((n, 2), 0.5, dtype=np.float32), 44100)
+        audio = bus.master()
+        self.assertEqual(audio.shape, (2000, 2))
+        self.assertTrue(np.abs(audio).max() <= 10**(-1/20.) + 1e-6)
+
+
+    def _slice_factory(self, i, n_samples, value, sample_rate=44100):
+        path = os.path.join(self.dir, 'slice_{0}.wav'.format(i))
+        data = np.full((n_samples, 2), value * 32767).astype('<i2')
+        f = wave.open(path, 'wb')
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(data.tobytes())
+        f.close()
+        return Slice(path, n_samples, sample_rate)
+
+
+class SpotifyTests(DatastoreTestCase):
+    """
+    Runs lookups against a local stand-in for the Spotify API.
+    """
+    def setUp(self):
+        super(SpotifyTests, self).setUp()
+        requests = self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                requests.append(url.path)
+
+                # Rate limit the first request
+                if len(requests) == 1:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0')
+                    self.end_headers()
+                    return
+
+                if url.path == '/v1/search':
+                    title = query['q'][0].split('track:')[-1]
+                    if title == 'broken':
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                    items = [{'id': title, 'name': title}] if title != 'missing' else []
+                    body = {'tracks': {'items': items}}
+                else:
+                    body = {'audio_features': [{'id': id, 'tempo': 120.} for id in query['ids'][0].split(',')]}
+
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode('utf8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        titles = dict(zip(self.files, ['a', 'b', 'missing']))
+        self.get_artist_and_title = spotify.get_artist_and_title
+        spotify.get_artist_and_title = lambda path: ('artist', titles[path])
+
+
+    def tearDown(self):
+        spotify.get_artist_and_title = self.get_artist_and_title
+        self.server.shutdown()
+        self.server.server_close()
+        super(SpotifyTests, self).tearDown()
+
+
+    def test_get_audio_features(self):
+        api_base = 'http://127.0.0.1:{0}/v1'.format(self.server.server_port)
+        client = spotify.Client(token='token', api_base=api_base)
+
+        results = spotify.get_audio_features(self.files, client=client)
+        self.assertEqual([r and r['meta']['id'] for r in results], ['a', 'b', None])
+        self.assertEqual(results[0]['features'], {'id': 'a', 'tempo': 120.})
+
+        # 3 searches (one retried) and one request for all the features
+        self.assertEqual(sorted(self.requests), ['/v1/audio-features'] + ['/v1/search'] * 4)
+
+        # Lookups are cached, even for songs which couldn't be found
+        n = len(self.requests)
+        self.assertEqual(spotify.get_audio_features(self.files, client=client), results)
+        self.assertEqual(len(self.requests), n)
+
+
+    def test_failed_lookup(self):
+        api_base = 'http://127.0.0.1:{0}/v1'.format(self.server.server_port)
+        client = spotify.Client(token='token', api_base=api_base)
+        titles = dict(zip(self.files, ['a', 'broken', 'b']))
+        spotify.get_artist_and_title = lambda path: ('artist', titles[path])
+
+        # The other songs are still looked up
+        results = spotify.get_audio_features(self.files, client=client)
+        self.assertEqual([r and r['meta']['id'] for r in results], ['a', None, 'b'])
+
+        # Only the failed lookup is tried again
+        n = len(self.requests)
+        spotify.get_audio_features(self.files, client=client)
+        self.assertEqual(self.requests[n:], ['/v1/search'])
+
+
+class DigletTests(unittest.TestCase):
+    """
+    Crawls a local stand-in for YouTube.
+    """
+    # Each video's related videos (with cycles)
+    graph = {
+        '0': ['1', '2', '3'],
+        '1': ['0', '2', '4'],
+        '2': ['4', '5'],
+        '3': ['1'],
+        '4': ['5', '6', '0'],
+        '5': ['2'],
+        '6': ['7'],
+        '7': [],
+    }
+
+    def setUp(self):
+        graph = self.graph = dict(self.graph)
+        fetched = self.fetched = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                video = parse_qs(urlparse(self.path).query)['v'][0]
+                fetched.append(video)
+                if video not in graph:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                links = ''.join('<a class="content-link" href="/watch?v={0}">{0}</a>'.format(v) for v in graph[video])
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write('<html><div id="watch-related">{0}</div></html>'.format(links).encode('utf8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def test_crawl(self):
+        url = 'http://127.0.0.1:{0}/watch?v={{0}}'.format(self.server.server_port)
+        urls = diglet.crawl(url.format('0'), depth=3, jobs=4, rate=None)
+        self.assertEqual(urls, [url.format(v) for v in ['0', '1', '2', '3', '4', '5', '6']])
+
+        # Pages are only fetched once, however many pages link to them
+        self.assertEqual(sorted(self.fetched), ['0', '1', '2', '3', '4', '5'])
+
+
+    def test_crawl_errors(self):
+        # A page which can't be fetched is skipped, and the rest are still crawled
+        self.graph['0'] = ['1', 'x', '3']
+        url = 'http://127.0.0.1:{0}/watch?v={{0}}'.format(self.server.server_port)
+        urls = diglet.crawl(url.format('0'), depth=2, jobs=4, rate=None, timeout=1)
+        self.assertEqual(urls, [url.format(v) for v in ['0', '1', 'x', '3', '2', '4']])
+
+
+    def test_rate_limiter(self):
+        limiter = diglet.RateLimiter(100)
+        start = time.time()
+        for _ in range(6):
+            limiter.wait('http://a.com/')
+        limiter.wait('http://b.com/')
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertLess(time.time() - start, 0.5)
+
+
+class DownloadTests(DatastoreTestCase):
+    def test_video_id(self):
+        self.assertEqual(diglet.video_id('https://www.youtube.com/watch?v=uS2nWLz-AbE&t=10'), 'uS2nWLz-AbE')
+        self.assertEqual(diglet.video_id('https://youtu.be/uS2nWLz-AbE'), 'uS2nWLz-AbE')
+
+
+    def test_pending(self):
+        outdir = os.path.join(self.dir, 'dug')
+        os.makedirs(outdir)
+        url = 'https://www.youtube.com/watch?v={0}'.format
+        ids = ['aaaaaaaaaaa', 'bbbbbbbbbbb', 'ccccccccccc', 'ddddddddddd', 'eeeeeeeee-e']
+
+        # Downloaded before the index existed
+        shutil.copy(self.files[0], os.path.join(outdir, 'Some Song-{0}.mp3'.format(ids[4])))
+        diglet.record_download(ids[0], self.files[1])
+        datastore.save_downloads([(ids[1], None, None, diglet.FILTERED, 400.),
+                                  (ids[2], datastore.fingerprint(self.files[1]), None, diglet.DUPLICATE, None)])
+
+        todo, skipped = diglet.pending([url(id) for id in ids], outdir, max_duration=360)
+        self.assertEqual(todo, [url(ids[3])])
+        self.assertEqual(skipped, [(url(ids[0]), diglet.DOWNLOADED),
+                                   (url(ids[1]), diglet.FILTERED),
+                                   (url(ids[2]), diglet.DUPLICATE),
+                                   (url(ids[4]), diglet.DOWNLOADED)])
+
+        # Longer videos are allowed, and removed downloads (and so
+        # duplicates of them) are downloaded again
+        os.remove(self.files[1])
+        todo, _ = diglet.pending([url(id) for id in ids], outdir, max_duration=600)
+        self.assertEqual(todo, [url(ids[0]), url(ids[1]), url(ids[2]), url(ids[3])])
+
+        # Digging into a new directory
+        todo, _ = diglet.pending([url(ids[3])], os.path.join(self.dir, 'new'))
+        self.assertEqual(todo, [url(ids[3])])
+
+
+    def test_record_download(self):
+        copy = os.path.join(self.dir, 'copy.mp3')
+        shutil.copy(self.files[0], copy)
+        self.assertEqual(diglet.record_download('aaaaaaaaaaa', self.files[0]), diglet.DOWNLOADED)
+        self.assertEqual(diglet.record_download('aaaaaaaaaaa', self.files[0]), diglet.DOWNLOADED)
+
+        # Same audio as another download
+        self.assertEqual(diglet.record_download('bbbbbbbbbbb', copy), diglet.DUPLICATE)
+        self.assertFalse(os.path.exists(copy))
+
+        # Same audio as an analyzed song
+        datastore.save(self.files[1], 120., Key('C', 'major'))
+        shutil.copy(self.files[1], copy)
+        self.assertEqual(diglet.record_download('ccccccccccc', copy), diglet.DUPLICATE)
+        self.assertEqual(datastore.load_downloads(['bbbbbbbbbbb', 'ccccccccccc', 'ddddddddddd']), {
+            'bbbbbbbbbbb': (datastore.fingerprint(self.files[0]), None, diglet.DUPLICATE, None),
+            'ccccccccccc': (datastore.fingerprint(self.files[1]), None, diglet.DUPLICATE, None),
+        })
+
+
+    def test_redig_deleted(self):
+        outdir = os.path.join(self.dir, 'dug')
+        os.makedirs(outdir)
+        url = 'https://www.youtube.com/watch?v={0}'.format
+        path = os.path.join(outdir, 'Song-aaaaaaaaaaa.mp3')
+        copy = os.path.join(outdir, 'Song-bbbbbbbbbbb.mp3')
+
+        # Downloaded and analyzed, then downloaded again by another video
+        shutil.copy(self.files[0], path)
+        self.assertEqual(diglet.record_download('aaaaaaaaaaa', path), diglet.DOWNLOADED)
+        datastore.save(path, 120., Key('C', 'major'))
+        shutil.copy(path, copy)
+        self.assertEqual(diglet.record_download('bbbbbbbbbbb', copy), diglet.DUPLICATE)
+
+        # Once it's deleted (and isn't anywhere else), both are downloaded again
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        os.remove(self.files[0])
+        todo, _ = diglet.pending([url('aaaaaaaaaaa'), url('bbbbbbbbbbb')], outdir)
+        self.assertEqual(todo, [url('aaaaaaaaaaa'), url('bbbbbbbbbbb')])
+
+        # and kept, even though it was analyzed
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(diglet.record_download('aaaaaaaaaaa', path), diglet.DOWNLOADED)
+        self.assertTrue(os.path.exists(path))
+
+
+    def test_dig_analyze(self):
+        from pablo import analysis
+        outdir = os.path.join(self.dir, 'dug')
+        os.makedirs(outdir)
+        url = 'https://www.youtube.com/watch?v={0}'.format
+        ids = ['aaaaaaaaaaa', 'bbbbbbbbbbb']
+
+        # Dug before, but not analyzed
+        old = os.path.join(outdir, 'Old Song-ccccccccccc.m4a')
+        shutil.copy(self.files[2], old)
+
+        def download(urls, outdir_, max_duration, transcode=True, downloaded=None):
+            self.assertFalse(transcode)
+            for i, u in enumerate(urls):
+                path = os.path.join(outdir_, 'Song-{0}.webm'.format(diglet.video_id(u)))
+                shutil.copy(self.files[i], path)
+                if diglet.record_download(diglet.video_id(u), path) == diglet.DOWNLOADED:
+                    downloaded(path)
+
+        extract, crawl, _download = analysis.extract, diglet.crawl, diglet._download
+        analysis.extract = lambda infile, features: analysis.Analysis(120., Key('C', 'major'), [0.5], None, None, 1., 0.9)
+        diglet.crawl = lambda start, depth, jobs: [url(id) for id in ids]
+        diglet._download = download
+        try:
+            diglet.dig(url(ids[0]), outdir, transcode=False, analyze=True)
+        finally:
+            analysis.extract, diglet.crawl, diglet._download = extract, crawl, _download
+
+        files = [old] + [os.path.join(outdir, 'Song-{0}.webm'.format(id)) for id in ids]
+        self.assertEqual(analysis.pending(files), [])
+
+
+def _process_song(song, **kwargs):
+    # Stands in for `pipeline._process_song`, finishing out of order
+    file, bpm, key = song
+    time.sleep(0.05 * (3 - int(file)))
+    return file, [os.getpid()], []
+
+
+def _make_mix(focal, selections, outdir, sample_sizes, **kwargs):
+    # Stands in for `pipeline.make_mix`, failing for one mix
+    if outdir == 'mix_1':
+        raise RuntimeError('No slices')
+    return os.path.join(outdir, '_mix.mp3')
+
+
+class PipelineTests(DatastoreTestCase):
+    def test_validate(self):
+        self.assertIsNone(pipeline.validate(16, 32, 2, 4, 512))
+        self.assertIsNone(pipeline.validate(16, 32, 2, None, 512))
+        self.assertIsNotNone(pipeline.validate(32, 16, 2, 4, 512))
+        self.assertIsNotNone(pipeline.validate(16, 24, 2, 4, 512))
+        self.assertIsNotNone(pipeline.validate(12, 32, 2, 4, 512))
+        self.assertIsNotNone(pipeline.validate(16, 32, 2, 4, 500))
+        self.assertIsNotNone(pipeline.validate(16, 32, 3, 2, 512))
+
+
+    def test_select_songs(self):
+        datastore.save_many([(self.files[0], 120., Key('C', 'major')),
+                             (self.files[1], 125., Key('G', 'major'))])
+
+        # Analyzed songs are preferred as the focal song,
+        # and songs which can't be analyzed are skipped
+        lib = library.Library(self.files)
+        for _ in range(5):
+            focal, selections = pipeline.select_songs(lib, n_songs=2)
+            self.assertIn(focal[0], self.files[:2])
+            self.assertEqual([s[0] for s in selections], [f for f in self.files[:2] if f != focal[0]])
+
+        focal, selections = pipeline.select_songs(lib, focal=self.files[0], n_songs=1)
+        self.assertEqual((focal[0], focal[1], focal[2].key), (self.files[0], 120., 'C'))
+        self.assertEqual([(f, bpm, key.key) for f, bpm, key in selections], [(self.files[1], 125., 'G')])
+
+
+    def test_select_songs_seed(self):
+        datastore.save_many([(f, 120., Key('C', 'major')) for f in self.files])
+        lib = library.Library(self.files)
+        selected = [pipeline.select_songs(lib, n_songs=1, seed=seed) for seed in range(10)]
+        for seed, (focal, selections) in enumerate(selected):
+            focal_, selections_ = pipeline.select_songs(library.Library(self.files[::-1]), n_songs=1, seed=seed)
+            self.assertEqual(focal_[0], focal[0])
+            self.assertEqual([s[0] for s in selections_], [s[0] for s in selections])
+        self.assertGreater(len(set((f[0], s[0][0]) for f, s in selected)), 1)
+
+
+    def test_make_mixes(self):
+        import pablo
+        mixes = [((None, [], 'mix_{0}'.format(i), [16]), {'seed': i}) for i in range(4)]
+        make_mix = pipeline.make_mix
+        pipeline.make_mix = _make_mix
+        try:
+            results = sorted(pablo._make_mixes(mixes, jobs=2))
+        finally:
+            pipeline.make_mix = make_mix
+
+        # The other mixes are still made
+        self.assertEqual(results, [
+            ('mix_0', 0, os.path.join('mix_0', '_mix.mp3'), None),
+            ('mix_1', 1, None, 'RuntimeError: No slices'),
+            ('mix_2', 2, os.path.join('mix_2', '_mix.mp3'), None),
+            ('mix_3', 3, os.path.join('mix_3', '_mix.mp3'), None),
+        ])
+
+
+    def test_library_files(self):
+        import pablo
+        native = os.path.join(self.dir, 'dug.m4a')
+        shutil.copy(self.files[0], native)
+
+        # sox can't decode songs in their downloaded formats
+        self.assertEqual(sorted(pablo._library_files(self.dir, backend='numpy')), sorted(self.files + [native]))
+        self.assertEqual(sorted(pablo._library_files(self.dir, backend='sox')), sorted(self.files))
+
+
+    def test_batch_params(self):
+        from click.testing import CliRunner
+        from pablo import cli
+        runner = CliRunner()
+
+        result = runner.invoke(cli, ['batch', self.dir, self.dir, '-N', '0'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('at least one mix', result.output)
+
+        # Every combination of parameters is invalid
+        result = runner.invoke(cli, ['batch', self.dir, self.dir, '-C', '24', '-C', '32', '-c', '64'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output.count('Skipping'), 2)
+        self.assertFalse(any(f.startswith('pablo_batch') for f in os.listdir(self.dir)))
+
+        native = os.path.join(self.dir, 'dug.m4a')
+        shutil.copy(self.files[0], native)
+        result = runner.invoke(cli, ['batch', self.dir, self.dir, '-F', native])
+        self.assertIn('use -b numpy', result.output)
+
+    def test_process_songs_order(self):
+        songs = [(str(i), 120., Key('C', 'major')) for i in range(4)]
+        process_song = pipeline._process_song
+        pipeline._process_song = _process_song
+        try:
+            results = list(pipeline.process_songs(songs, 120., Key('C', 'major'), '', '', jobs=4))
+        finally:
+            pipeline._process_song = process_song
+
+        self.assertEqual([name for name, _, _ in results], ['0', '1', '2', '3'])
+        # In other processes
+        self.assertNotIn(os.getpid(), [pid for _, (pid,), _ in results])
+
+
+class MutateTests(unittest.TestCase):
+    def test_transform_beats(self):
+        beats = [1., 2., 3., 4.]
+
+        # Slowing down to half speed doubles the beat times
+        transforms = [mutate.tempo(120., 60.)]
+        self.assertEqual(list(mutate.transform_beats(beats, transforms)), [2., 4., 6., 8.])
+
+        # Trimming shifts them back, dropping those which were trimmed off
+        transforms = [mutate.tempo(120., 60.), mutate.trim()]
+        self.assertEqual(list(mutate.transform_beats(beats, transforms, 2.5)), [1.5, 3.5, 5.5])
+
+
+    def test_process(self):
+        sample_rate = 22050
+        t = np.arange(sample_rate * 2)/float(sample_rate)
+        tone = np.stack([np.sin(2 * np.pi * 440 * t)] * 2, axis=1).astype(np.float32)
+        audio = np.concatenate([np.zeros((sample_rate//2, 2), dtype=np.float32), tone])
+
+        written = []
+        load, write = mutate.load, mutate.write
+        mutate.load = lambda infile: (audio, sample_rate)
+        mutate.write = lambda audio, sample_rate, outfile: written.append(audio)
+        try:
+            transforms = [mutate.pitch(Key('C', 'major'), Key('D', 'major')),
+                          mutate.tempo(120., 60.),
+                          mutate.trim(),
+                          mutate.click([0.5])]
+            trimmed = mutate.process('song.wav', 'out.wav', transforms, backend='numpy')
+            self.assertRaises(ValueError, mutate.process, 'song.wav', 'out.wav', [('reverse', None)], backend='numpy')
+        finally:
+            mutate.load, mutate.write = load, write
+
+        # Decoded and encoded once, with every transform applied:
+        # stretched to twice as long, then (most of) the silence trimmed
+        self.assertEqual(len(written), 1)
+        self.assertAlmostEqual(len(written[0]), 2 * len(tone), delta=sample_rate//10)
+
+        # Exactly how much was trimmed is returned
+        self.assertAlmostEqual(trimmed, 1., delta=0.1)
+        self.assertEqual(len(written[0]), 2 * len(audio) - int(round(trimmed * sample_rate)))
+
+
+    def test_beat_slice(self):
+        sample_rate = 44100
+        audio = np.zeros((sample_rate * 30, 2), dtype=np.float32)
+
+        # Beats at 120bpm, slightly off the grid
+        rand = np.random.RandomState(0)
+        beats = np.arange(0.1, 28., 0.5) + rand.uniform(-0.002, 0.002, 56)
+
+        load, write = mutate.load, mutate.write
+        mutate.load = lambda infile: (audio, sample_rate)
+        mutate.write = lambda audio, sample_rate, outfile: outfile
+        try:
+            slices = mutate.beat_slice('song.wav', beats, 4, '/tmp')
+            slices_ = mutate.beat_slice('song.wav', beats, 4, '/tmp', length=1.5)
+        finally:
+            mutate.load, mutate.write = load, write
+
+        # Chunks of the same number of beats are exactly as long as each other
+        self.assertEqual(len(slices), 14)
+        self.assertEqual(len(set(s.n_samples for s in slices)), 1)
+        self.assertEqual(set(s.n_samples for s in slices_), {int(round(1.5 * sample_rate))})
+
+
+    def test_beat_slice_off_grid(self):
+        sample_rate = 44100
+        audio = np.zeros((sample_rate * 30, 2), dtype=np.float32)
+
+        # The third chunk's last beat has drifted by a tenth of a beat,
+        # and the fifth chunk can't be encoded
+        beats = np.arange(0.1, 28., 0.5)
+        beats[11] += 0.05
+        def write(audio, sample_rate, outfile):
+            if outfile.endswith('4.wav'):
+                raise RuntimeError('Could not encode')
+            return outfile
+
+        load, write_ = mutate.load, mutate.write
+        mutate.load = lambda infile: (audio, sample_rate)
+        mutate.write = write
+        try:
+            slices = mutate.beat_slice('song.wav', beats, 4, '/tmp', format='wav', length=1.5)
+        finally:
+            mutate.load, mutate.write = load, write_
+
+        # The drifting chunk is cut at its beats, so it's filtered out later
+        n_samples = [s.n_samples for s in slices]
+        self.assertEqual(len(slices), 13)
+        self.assertEqual(n_samples[2], int(round(beats[11] * sample_rate)) - int(round(beats[8] * sample_rate)))
+        self.assertEqual(set(n_samples[:2] + n_samples[3:]), {int(round(1.5 * sample_rate))})
+        self.assertNotIn('/tmp/4.wav', [s.file for s in slices])
+
+
+class DSPTests(unittest.TestCase):
+    def setUp(self):
+        self.sample_rate = 22050
+        t = np.arange(self.sample_rate * 2)/float(self.sample_rate)
+        self.audio = np.stack([np.sin(2 * np.pi * 440 * t)] * 2, axis=1).astype(np.float32)
+
+
+    def test_stretch(self):
+        audio = dsp.stretch(self.audio, length=50000)
+        self.assertEqual(audio.shape, (50000, 2))
+        self.assertAlmostEqual(self._pitch(audio), 440, delta=2)
+
+        audio = dsp.stretch(self.audio, ratio=2.)
+        self.assertEqual(len(audio), len(self.audio)//2)
+
+
+    def test_shift(self):
+        audio = dsp.shift(self.audio, 12)
+        self.assertEqual(audio.shape, self.audio.shape)
+        self.assertAlmostEqual(self._pitch(audio), 880, delta=4)
+
+
+    def test_trim_silence(self):
+        silence = np.zeros((1000, 2), dtype=np.float32)
+        audio, trimmed = dsp.trim_silence(np.concatenate([silence, self.audio]), self.sample_rate)
+        self.assertTrue(1000 - self.sample_rate//100 <= trimmed <= 1000)
+        self.assertEqual(len(audio) + trimmed, len(self.audio) + 1000)
+
+
+    def _pitch(self, audio):
+        mid = audio[len(audio)//4:3*len(audio)//4, 0]
+        spectrum = np.abs(np.fft.rfft(mid))
+        return np.argmax(spectrum) * self.sample_rate/float(len(mid))
+
+
+class StartupTests(unittest.TestCase):
+    # Checked in a fresh interpreter, after `pablo --help`
+    script = '''
+import sys
+from pablo import cli
+try:
+    cli(['--help'])
+except SystemExit:
+    pass
+heavy = [m for m in ['essentia', 'numpy', 'pydub', 'youtube_dl', 'requests', 'lxml'] if m in sys.modules]
+sys.stderr.write(','.join(heavy) or '-')
+'''
+
+    def test_startup(self):
+        # The heavy modules aren't imported just to start up
+        proc = subprocess.Popen([sys.executable, '-c', self.script],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        self.assertEqual(err.decode('utf8').split()[-1], '-')
+
+
+    def test_startup_time(self):
+        # `pablo --help` takes well under 100ms on top of starting python.
+        # The fastest of a few runs of each is compared,
+        # so that a busy machine doesn't fail this
+        overhead = min(self._time(self.script) for _ in range(3)) - \
+            min(self._time('pass') for _ in range(3))
+        self.assertLess(overhead, 0.1)
+
+
+    def _time(self, script):
+        start = time.time()
+        subprocess.Popen([sys.executable, '-c', script],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        return time.time() - start